@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+# ROM catalog: gamelist.xml scanning, compact in-memory storage and wire encoding for the dashboard.
+import os, sys, pickle, threading
+from array import array
+from pathlib import Path
+import gamelist_io
+
+MEDIA_TYPES = ("image", "video", "marquee", "thumbnail")
+MEDIA_SUFFIXES = {"image": "image", "video": "video", "marquee": "marquee", "thumbnail": "thumb"}
+# Bit positions of the per-game flags byte. The low four bits double as the "exists" column of the compact format.
+MEDIA_BITS = {mtype: 1 << i for i, mtype in enumerate(MEDIA_TYPES)}
+HAS_NAME_BIT = 1 << 4
+UNTRACKED_BIT = 1 << 5  # found on disk but not listed in gamelist.xml (see rom_discovery)
+MEDIA_MASK = sum(MEDIA_BITS.values())
+COLUMNS = ("rom_path", "game_name", "image_path", "video_path", "marquee_path", "thumbnail_path")
+# Stored instead of the file name when a media file follows the "<rom stem>-<suffix><ext>" convention.
+CONVENTIONAL_PREFIX = "\0"
+SNAPSHOT_VERSION = 1
+
+class SystemTable:
+    """
+    All games of one system as parallel lists. Game names equal to the ROM stem are stored as None,
+    media paths as an interned directory plus either the file name or, for files named after the
+    ROM, just the interned extension. Media existence and "has <name>" are bits in one byte per game.
+    """
+    __slots__ = ("name", "rom_paths", "names", "media_dirs", "media_files", "flags", "rows", "stamp")
+
+    def __init__(self, name, stamp=None):
+        self.name, self.stamp = sys.intern(name), stamp
+        self.rom_paths, self.names, self.flags, self.rows = [], [], array("B"), {}
+        self.media_dirs = {mtype: [] for mtype in MEDIA_TYPES}
+        self.media_files = {mtype: [] for mtype in MEDIA_TYPES}
+
+    def __len__(self):
+        return len(self.rom_paths)
+
+    def append(self, rom_path, game_name, has_name, media, untracked=False):
+        """media is {type: (path or None, exists)}."""
+        stem = _stem(rom_path)
+        self.rows[rom_path] = len(self.rom_paths)
+        self.rom_paths.append(rom_path)
+        self.names.append(None if game_name == stem else game_name)
+        flags = (HAS_NAME_BIT if has_name else 0) | (UNTRACKED_BIT if untracked else 0)
+        for mtype in MEDIA_TYPES:
+            path, exists = media.get(mtype, (None, False))
+            directory, filename = _pack_media_path(stem, mtype, path)
+            self.media_dirs[mtype].append(directory)
+            self.media_files[mtype].append(filename)
+            if exists: flags |= MEDIA_BITS[mtype]
+        self.flags.append(flags)
+
+    def stem(self, i):
+        return _stem(self.rom_paths[i])
+
+    def game_name(self, i):
+        name = self.names[i]
+        return name if name is not None else self.stem(i)
+
+    def media_path(self, i, mtype):
+        return _unpack_media_path(self.stem(i), mtype, self.media_dirs[mtype][i], self.media_files[mtype][i])
+
+    def game(self, i):
+        """The per-game dict of the legacy API."""
+        flags = self.flags[i]
+        game = {"rom_path": self.rom_paths[i], "game_name": self.game_name(i), "actual_system": self.name,
+                "has_name": bool(flags & HAS_NAME_BIT), "untracked": bool(flags & UNTRACKED_BIT)}
+        for mtype in MEDIA_TYPES:
+            game[f"{mtype}_path"] = self.media_path(i, mtype)
+            game[f"{mtype}_exists"] = bool(flags & MEDIA_BITS[mtype])
+        return game
+
+def _stem(rom_path):
+    # Same result as Path(rom_path).stem, without building a Path per row.
+    return os.path.splitext(rom_path.rpartition("/")[2])[0]
+
+def _pack_media_path(stem, mtype, path):
+    if not path: return None, None
+    directory, _, filename = path.rpartition("/")
+    conventional = f"{stem}-{MEDIA_SUFFIXES[mtype]}"
+    rest = filename[len(conventional):]
+    if filename.startswith(conventional) and (not rest or rest.startswith(".")):
+        return sys.intern(directory), sys.intern(CONVENTIONAL_PREFIX + rest)
+    return sys.intern(directory), filename
+
+def _unpack_media_path(stem, mtype, directory, filename):
+    if filename is None: return None
+    if filename.startswith(CONVENTIONAL_PREFIX):
+        filename = f"{stem}-{MEDIA_SUFFIXES[mtype]}{filename[1:]}"
+    return f"{directory}/{filename}" if directory else filename
+
+def gamelist_stamp(gamelist_path):
+    """(mtime_ns, size) of a gamelist.xml, None if it does not exist. Used to revalidate snapshot tables."""
+    try:
+        st = os.stat(gamelist_path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def load_system_table(system_name, gamelist_path):
+    """Parses one gamelist.xml into a SystemTable, streaming (descriptions and other unused tags are never kept)."""
+    table = SystemTable(system_name, gamelist_stamp(gamelist_path))
+    gamelist_dir = os.path.dirname(gamelist_path)
+
+    for attrib, values in gamelist_io.iter_games(gamelist_path, ("name",) + MEDIA_TYPES):
+        path_raw = attrib.get("path")
+        if not path_raw or attrib.get("deleted") == "yes" or path_raw in table.rows:
+            continue
+
+        media = {}
+        for tag_name in MEDIA_TYPES:
+            path = values.get(tag_name, "").strip() or None
+            full_path = (path if path.startswith('/') else os.path.join(gamelist_dir, path)) if path else None
+            media[tag_name] = (path, bool(full_path) and os.path.exists(full_path))
+        table.append(path_raw, (values["name"] or None) if "name" in values else Path(path_raw).stem, bool(values.get("name")), media)
+    return table
+
+def _gamelist_paths(base_dir):
+    for system_name in sorted(os.listdir(base_dir)):
+        gamelist_path = os.path.join(base_dir, system_name, "gamelist.xml")
+        if os.path.isfile(gamelist_path):
+            yield system_name, gamelist_path
+
+def _try_load_system_table(system_name, gamelist_path):
+    try:
+        return load_system_table(system_name, gamelist_path)
+    except Exception as e:
+        print(f"Error processing gamelist for {system_name}: {e}")
+        return None
+
+def build_catalog(base_dir):
+    """Scans every system folder below base_dir."""
+    tables = {}
+    for system_name, gamelist_path in _gamelist_paths(base_dir):
+        table = _try_load_system_table(system_name, gamelist_path)
+        if table is not None and len(table):
+            tables[table.name] = table
+    return Catalog(tables)
+
+def save_snapshot(catalog, snapshot_path):
+    """Pickles the catalog tables (written to a temp file, then renamed into place)."""
+    tmp_path = f"{snapshot_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"version": SNAPSHOT_VERSION, "tables": catalog.tables}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+    catalog.saved_generation = catalog.generation
+
+def load_snapshot(snapshot_path):
+    """Returns the Catalog stored by save_snapshot(), or None if there is no usable snapshot."""
+    try:
+        with open(snapshot_path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != SNAPSHOT_VERSION: return None
+        catalog = Catalog(data["tables"])
+        catalog.saved_generation = catalog.generation
+        return catalog
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable catalog snapshot {snapshot_path}: {e}")
+        return None
+
+SCRAPE_STATUSES = ("unscraped", "partial", "complete")
+
+def scrape_status(flags, media_mask=MEDIA_MASK):
+    present = flags & media_mask
+    if present == media_mask and flags & HAS_NAME_BIT: return "complete"
+    if not present and not flags & HAS_NAME_BIT: return "unscraped"
+    return "partial"
+
+SORT_KEYS = {
+    "name": lambda t, i: t.game_name(i).lower(),
+    "rom": lambda t, i: t.rom_paths[i].lower(),
+    "system": lambda t, i: (t.name, t.game_name(i).lower()),
+    "missing": lambda t, i: bin(~t.flags[i] & MEDIA_MASK).count("1"),
+}
+
+class Catalog:
+    """{system: SystemTable} with O(1) (system, rom_path) lookups, filtered queries and the wire encodings."""
+    def __init__(self, tables=None):
+        self.tables = tables or {}
+        self._lock = threading.Lock()
+        # {system: [rom_path]} found on disk but missing from gamelist.xml, re-merged whenever a table is reloaded.
+        self.untracked = {name: [t.rom_paths[i] for i, flags in enumerate(t.flags) if flags & UNTRACKED_BIT] for name, t in self.tables.items()}
+        self.untracked = {name: paths for name, paths in self.untracked.items() if paths}
+        # Bumped on every table change, so periodic snapshots are only written when something changed.
+        self.generation, self.saved_generation = 0, None
+
+    def __bool__(self):
+        return bool(self.tables)
+
+    def __len__(self):
+        return sum(len(t) for t in self.tables.values())
+
+    def get(self, system_name, rom_path):
+        table = self.tables.get(system_name)
+        i = table.rows.get(rom_path) if table else None
+        return table.game(i) if i is not None else None
+
+    def revalidate(self, base_dir, systems=None):
+        """
+        Reloads the tables of the given systems (all if None) whose gamelist.xml changed since it
+        was parsed, adds new systems and drops vanished ones. Only costs a stat per unchanged system.
+        Returns the names of the reloaded systems.
+        """
+        with self._lock:
+            tables = dict(self.tables)
+            if systems is None:
+                candidates = dict(_gamelist_paths(base_dir))
+                candidates.update({name: os.path.join(base_dir, name, "gamelist.xml") for name in self.untracked if name not in candidates})
+                changed = [name for name in tables if name not in candidates]
+                for gone in changed:
+                    del tables[gone]
+            else:
+                candidates, changed = {name: os.path.join(base_dir, name, "gamelist.xml") for name in systems}, []
+            for system_name, gamelist_path in candidates.items():
+                table = tables.get(system_name)
+                stamp = gamelist_stamp(gamelist_path)
+                if table is not None and table.stamp == stamp:
+                    continue
+                new_table = _try_load_system_table(system_name, gamelist_path) if stamp else None
+                if system_name in self.untracked:
+                    new_table = self._add_untracked(new_table or SystemTable(system_name, stamp), system_name, self.untracked[system_name])
+                if new_table is not None and len(new_table):
+                    tables[system_name] = new_table
+                elif system_name in tables:
+                    del tables[system_name]
+                else:
+                    continue
+                changed.append(system_name)
+            if changed:
+                # Swapped in as a whole so concurrent readers never see a dict changing size.
+                self.tables = dict(sorted(tables.items()))
+                self.generation += 1
+            return changed
+
+    def rebuild(self, base_dir):
+        """
+        Rescans every system folder like build_catalog(), in place: the untracked ROMs are merged into
+        the new tables and the swap happens under the lock merge_untracked() takes, so neither loses the other's rows.
+        """
+        tables = build_catalog(base_dir).tables
+        with self._lock:
+            for system_name, rom_paths in self.untracked.items():
+                table = tables.get(system_name) or SystemTable(system_name, gamelist_stamp(os.path.join(base_dir, system_name, "gamelist.xml")))
+                tables[system_name] = self._add_untracked(table, system_name, rom_paths)
+            self.tables = dict(sorted(tables.items()))
+            self.generation += 1
+
+    def merge_untracked(self, system_name, rom_paths):
+        """
+        Adds ROMs found on disk that the system's gamelist.xml does not list yet, as unscraped rows
+        flagged UNTRACKED_BIT. Returns the number of rows added.
+        """
+        with self._lock:
+            old = self.tables.get(system_name)
+            known = old.rows if old is not None else {}
+            untracked = [p for p in rom_paths if p not in known or old.flags[known[p]] & UNTRACKED_BIT]
+            if untracked: self.untracked[system_name] = untracked
+            else: self.untracked.pop(system_name, None)
+            new_paths = [p for p in untracked if p not in known]
+            if not new_paths: return 0
+            table = SystemTable(system_name, old.stamp if old is not None else None)
+            if old is not None:
+                for i in range(len(old)):
+                    table.append(old.rom_paths[i], old.game_name(i), bool(old.flags[i] & HAS_NAME_BIT),
+                                 {mtype: (old.media_path(i, mtype), bool(old.flags[i] & MEDIA_BITS[mtype])) for mtype in MEDIA_TYPES},
+                                 bool(old.flags[i] & UNTRACKED_BIT))
+            self._add_untracked(table, system_name, new_paths)
+            self.tables = dict(sorted({**self.tables, system_name: table}.items()))
+            self.generation += 1
+            return len(new_paths)
+
+    @staticmethod
+    def _add_untracked(table, system_name, rom_paths):
+        for rom_path in rom_paths:
+            if rom_path not in table.rows:
+                table.append(rom_path, _stem(rom_path), False, {}, untracked=True)
+        return table
+
+    def summary(self):
+        return {"systems": {name: len(t) for name, t in self.tables.items()}, "total": len(self)}
+
+    def with_all_list(self):
+        """Legacy dashboard layout: every game again under "ALL" (shared dicts, not copies)."""
+        systems = {name: [t.game(i) for i in range(len(t))] for name, t in self.tables.items()}
+        return {"ALL": [game for games in systems.values() for game in games], **systems}
+
+    def query(self, system=None, missing=(), text=None, prefix=None, status=None, sort=None, descending=False, media_types=MEDIA_TYPES):
+        """
+        Returns the matching games as (table, row) references. "missing" keeps games lacking any
+        of the given media types, "text" is a case-insensitive substring and "prefix" a
+        case-insensitive prefix on the ROM stem or game name, "status" one of SCRAPE_STATUSES
+        computed over media_types.
+        """
+        if system and system != "ALL":
+            tables = [self.tables[system]] if system in self.tables else []
+        else:
+            tables = list(self.tables.values())
+        missing_mask = sum(MEDIA_BITS[m] for m in missing if m in MEDIA_BITS)
+        status_mask = sum(MEDIA_BITS[m] for m in media_types if m in MEDIA_BITS)
+        text, prefix = (text or "").lower(), (prefix or "").lower()
+        matches = []
+        for table in tables:
+            for i, flags in enumerate(table.flags):
+                if missing_mask and flags & missing_mask == missing_mask:
+                    continue
+                if status and scrape_status(flags, status_mask) != status:
+                    continue
+                if text or prefix:
+                    stem, name = table.stem(i).lower(), (table.names[i] or "").lower()
+                    if text and text not in stem and text not in name: continue
+                    if prefix and not (stem.startswith(prefix) or name.startswith(prefix)): continue
+                matches.append((table, i))
+        if sort in SORT_KEYS:
+            key = SORT_KEYS[sort]
+            matches.sort(key=lambda ref: key(*ref), reverse=descending)
+        return matches
+
+    def encode_columns(self, systems=None, offset=0, limit=None):
+        """
+        Column-oriented encoding. Each column is one list with a value per row, the system of a
+        row is an index into "systems" and the four *_exists flags are packed into the "exists"
+        bitmask (see MEDIA_BITS). "ranges" maps every system to [start, count] within the rows,
+        so per-system lists are index references instead of duplicated games.
+        """
+        systems = [s for s in (systems if systems is not None else self.tables) if s in self.tables]
+        refs = [(self.tables[s], i) for s in systems for i in range(len(self.tables[s]))]
+        return _encode(refs, systems, offset, limit, with_ranges=True)
+
+    def encode_rows(self, refs, offset=0, limit=None):
+        """encode_columns() for query() results, keeping their order and without "ranges"."""
+        systems = list(dict.fromkeys(table.name for table, _ in refs))
+        return _encode(refs, systems, offset, limit, with_ranges=False)
+
+    def memory_report(self):
+        """Deep size of the in-memory catalog (shared and interned objects counted once)."""
+        seen = set()
+        by_system = {name: _deep_sizeof(table, seen) for name, table in self.tables.items()}
+        total, games = sum(by_system.values()), len(self)
+        return {"games": games, "bytes": total, "bytes_per_game": round(total / games, 1) if games else 0, "systems": by_system}
+
+def _encode(refs, systems, offset, limit, with_ranges):
+    total = len(refs)
+    end = total if limit is None else min(total, offset + limit)
+    refs = refs[offset:end]
+
+    payload = {"format": "columns", "version": 1, "systems": systems, "total": total, "offset": offset,
+               "system": [], "exists": [], **{col: [] for col in COLUMNS}}
+    system_index = {name: i for i, name in enumerate(systems)}
+    ranges = {}
+    for row, (table, i) in enumerate(refs):
+        start, count = ranges.get(table.name, (row, 0))
+        ranges[table.name] = (start, count + 1)
+        payload["system"].append(system_index[table.name])
+        payload["exists"].append(table.flags[i] & MEDIA_MASK)
+        stem, name = table.stem(i), table.names[i]
+        payload["rom_path"].append(table.rom_paths[i])
+        payload["game_name"].append(name if name is not None else stem)
+        for mtype in MEDIA_TYPES:
+            payload[f"{mtype}_path"].append(_unpack_media_path(stem, mtype, table.media_dirs[mtype][i], table.media_files[mtype][i]))
+    if with_ranges:
+        payload["ranges"] = {name: list(r) for name, r in ranges.items()}
+    return payload
+
+def _deep_sizeof(obj, seen):
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_sizeof(v, seen) for v in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(_deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+def legacy_memory_estimate(catalog):
+    """Deep size the same games take as per-game dicts plus the "ALL" list (the pre-SystemTable layout)."""
+    return _deep_sizeof(catalog.with_all_list(), set())
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Streaming gamelist.xml reading and rewriting: one <game> in memory at a time instead of the whole DOM.
+import os, xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+def _top_level(gamelist_path):
+    """
+    Yields (root, element) for each child of the root, complete with its tail: an element is only handed out
+    once the next one starts (or the root ends), as iterparse reports "end" before reading the text after it.
+    The caller's use of an element ends before the next one.
+    """
+    depth, root, done = 0, None, None
+    for event, el in ET.iterparse(gamelist_path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if root is None: root = el
+            elif depth == 2 and done is not None:
+                yield root, done
+                root.remove(done)  # keeps root (and so memory) from growing with the file
+                done = None
+        else:
+            depth -= 1
+            if depth == 1: done = el
+            elif depth == 0 and done is not None:
+                yield root, done
+
+def iter_games(gamelist_path, fields):
+    """
+    Yields (attributes, {tag: text}) per <game>, with only the child tags in fields that are present
+    (text "" if empty). Raises ET.ParseError for a malformed file, possibly after some games.
+    """
+    for _, el in _top_level(gamelist_path):
+        if el.tag != "game": continue
+        values = {}
+        for tag in fields:
+            child = el.find(tag)
+            if child is not None: values[tag] = child.text or ""
+        yield dict(el.attrib), values
+
+def find_game(gamelist_path, rom_path, fields):
+    """{tag: text} (see iter_games) of the first <game> whose path is rom_path, None if there is none. Stops reading there."""
+    for attrib, values in iter_games(gamelist_path, fields):
+        if attrib.get("path") == rom_path: return values
+    return None
+
+def _open_tag(el):
+    tag = ET.tostring(ET.Element(el.tag, el.attrib), encoding="unicode")
+    return f"{tag[:-3]}>"  # "<gameList a="b" />" -> "<gameList a="b">"
+
+def rewrite(gamelist_path, edit, append=None):
+    """
+    Copies gamelist_path to a temp file one top-level element at a time and swaps it in (a missing file
+    counts as an empty <gameList>). edit(el) may change each element in place and returns False to drop it;
+    append() is called at the end and returns the elements to add before the closing tag. Output is what
+    ElementTree.write would produce for the same tree. On ET.ParseError the file is left untouched.
+    """
+    tmp_path = f"{gamelist_path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            root = None
+            if os.path.exists(gamelist_path):
+                for root_el, el in _top_level(gamelist_path):
+                    if root is None:
+                        root = root_el
+                        out.write(_open_tag(root) + escape(root.text or ""))
+                    if edit(el) is not False:
+                        out.write(ET.tostring(el, encoding="unicode"))
+                if root is None:
+                    # No children: the loop never ran, parse once more for the (small) root itself.
+                    root = ET.parse(gamelist_path).getroot()
+                    out.write(_open_tag(root) + escape(root.text or ""))
+            else:
+                root = ET.Element("gameList")
+                out.write(_open_tag(root))
+            for el in (append() if append else ()):
+                out.write(ET.tostring(el, encoding="unicode"))
+            out.write(f"</{root.tag}>")
+        os.replace(tmp_path, gamelist_path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
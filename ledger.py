@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Persistent per-ROM scrape results, so re-runs can skip known failures or retry only what failed.
+import os, json, time, sqlite3, threading
+
+STATUSES = ("matched", "skipped", "failed", "error")
+
+class ScrapeLedger:
+    """
+    One row per (system, rom_path) with the outcome of its last scrape: status (see STATUSES), match
+    method, ScreenScraper game id, media types fetched, attempt count and timestamps. SQLite, so a
+    batch only appends/updates rows and the summary is a single GROUP BY.
+    """
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db, self._lock = sqlite3.connect(db_path, check_same_thread=False), threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS results (
+                system TEXT NOT NULL, rom_path TEXT NOT NULL, status TEXT NOT NULL, method TEXT, game_id TEXT,
+                media TEXT, message TEXT, attempts INTEGER NOT NULL DEFAULT 1, first_scraped REAL NOT NULL,
+                last_scraped REAL NOT NULL, last_matched REAL, PRIMARY KEY (system, rom_path))""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_status ON results (system, status)")
+
+    def record(self, system, rom_path, status, method=None, game_id=None, media=(), message=None):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("""INSERT INTO results (system, rom_path, status, method, game_id, media, message, first_scraped, last_scraped, last_matched)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (system, rom_path) DO UPDATE SET status = excluded.status, method = excluded.method,
+                    game_id = COALESCE(excluded.game_id, game_id), media = excluded.media, message = excluded.message,
+                    attempts = attempts + 1, last_scraped = excluded.last_scraped, last_matched = COALESCE(excluded.last_matched, last_matched)""",
+                (system, rom_path, status, method, game_id, json.dumps(list(media)), message, now, now, now if status == "matched" else None))
+
+    def get(self, system, rom_path):
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM results WHERE system = ? AND rom_path = ?", (system, rom_path))
+            row = cursor.fetchone()
+            if row is None: return None
+            entry = dict(zip((c[0] for c in cursor.description), row))
+        entry["media"] = json.loads(entry["media"] or "[]")
+        return entry
+
+    def rom_paths(self, system, statuses=("failed", "error")):
+        """ROM paths of a system whose last scrape ended with one of the given statuses."""
+        with self._lock:
+            rows = self._db.execute(f"SELECT rom_path FROM results WHERE system = ? AND status IN ({','.join('?' * len(statuses))}) ORDER BY rom_path",
+                                    (system, *statuses)).fetchall()
+        return [row[0] for row in rows]
+
+    def recent_failures(self, system, max_age_days):
+        """ROM paths of a system that failed to match within the last max_age_days."""
+        with self._lock:
+            rows = self._db.execute("SELECT rom_path FROM results WHERE system = ? AND status = 'failed' AND last_scraped >= ?",
+                                    (system, time.time() - max_age_days * 86400)).fetchall()
+        return {row[0] for row in rows}
+
+    def summary(self):
+        """{system: {status: count, ..., "last_scraped": ts}} over the whole ledger."""
+        with self._lock:
+            rows = self._db.execute("SELECT system, status, COUNT(*), MAX(last_scraped) FROM results GROUP BY system, status").fetchall()
+        report = {}
+        for system, status, count, last_scraped in rows:
+            entry = report.setdefault(system, {s: 0 for s in STATUSES} | {"last_scraped": 0})
+            entry[status] = count
+            entry["last_scraped"] = max(entry["last_scraped"], last_scraped)
+        return report
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Orphaned-media and stale-entry garbage collector for the ROM folders and the media store.
+import os, re, json, time, xml.etree.ElementTree as ET
+from catalog import MEDIA_TYPES, MEDIA_SUFFIXES
+import gamelist_io
+
+# Only files the scraper itself names "<rom stem>-<suffix>.<ext>" are ever considered orphans.
+SCRAPER_MEDIA_RE = re.compile(r"-(%s)\.[A-Za-z0-9]+$" % "|".join(sorted(set(MEDIA_SUFFIXES.values()))))
+REPORT_LIMIT = 500
+
+def _resolve(gamelist_dir, path):
+    return os.path.normpath(path if path.startswith("/") else os.path.join(gamelist_dir, path))
+
+def scan_gamelist(gamelist_path):
+    """
+    One streaming pass over a gamelist.xml. Returns (referenced media paths, media dirs, rom paths),
+    the paths absolute and normalized; rom paths as (xml path, absolute path) pairs.
+    """
+    gamelist_dir = os.path.dirname(gamelist_path)
+    referenced, media_dirs, roms = set(), set(), []
+    for attrib, values in gamelist_io.iter_games(gamelist_path, ("path",) + MEDIA_TYPES):
+        rom_path = values.get("path") or attrib.get("path")
+        if rom_path:
+            roms.append((rom_path, _resolve(gamelist_dir, rom_path.strip())))
+        for mtype in MEDIA_TYPES:
+            text = values.get(mtype, "").strip()
+            if text:
+                media_path = _resolve(gamelist_dir, text)
+                referenced.add(media_path)
+                media_dirs.add(os.path.dirname(media_path))
+    return referenced, media_dirs, roms
+
+def _within(base_dir, path):
+    return os.path.commonpath([base_dir, path]) == base_dir
+
+def _processed_sources(record_path, referenced):
+    """SHA1s of the originals that referenced files were optimized from (media_postprocess keeps them as blobs)."""
+    try:
+        with open(record_path, "r", encoding="utf-8") as f: records = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {(record.get("source") or {}).get("sha1") for path, record in records.items() if os.path.normpath(path) in referenced}
+
+def _listing(directory, cache):
+    """Names in a directory, one scandir per directory."""
+    if directory not in cache:
+        try:
+            with os.scandir(directory) as it: cache[directory] = {e.name for e in it}
+        except OSError:
+            cache[directory] = set()
+    return cache[directory]
+
+def _prune_entries(gamelist_path, stale_paths):
+    gamelist_io.rewrite(gamelist_path, lambda node: node.tag != "game" or (node.findtext("path") or node.get("path")) not in stale_paths)
+
+def collect_garbage(base_dir, media_folder_name="downloaded_images", dry_run=True, prune_entries=False, store_dir=None,
+                    include_store=False, processed_record_path=None):
+    """
+    Finds scraper-named media files that no gamelist references (in each system's media folder and every
+    folder under base_dir a gamelist points into), gamelist entries whose ROM file is gone and, with a
+    store_dir, store blobs nothing links to any more. Unless dry_run, deletes the orphaned files, the stale
+    entries (prune_entries) and the unreferenced blobs (include_store). Returns a JSON-ready report.
+    A file counts as referenced if any system's gamelist points to it, since gamelists may point into
+    each other's folders; folders outside base_dir are never scanned. If a gamelist cannot be parsed,
+    orphans are only reported, not deleted. A blob is kept while a referenced file optimized from it is
+    listed in processed_record_path (media_postprocess), since optimizing gave that file its own inode.
+    """
+    started = time.perf_counter()
+    report = {"dry_run": dry_run, "systems": {}, "orphan_files": [], "stale_entries": [], "store_blobs": [],
+              "orphan_count": 0, "orphan_bytes": 0, "stale_count": 0, "store_count": 0, "store_bytes": 0}
+    listings, symlink_targets, scanned_dirs = {}, set(), set()
+    base_dir = os.path.abspath(base_dir)
+
+    # Pass 1: the references of every gamelist, before any file is judged.
+    systems, referenced, delete_orphans = [], set(), not dry_run
+    for system_name in sorted(os.listdir(base_dir)):
+        system_dir = os.path.join(base_dir, system_name)
+        gamelist_path = os.path.join(system_dir, "gamelist.xml")
+        if not os.path.isdir(system_dir): continue
+        system_refs, media_dirs, roms = set(), set(), []
+        if os.path.isfile(gamelist_path):
+            try:
+                system_refs, media_dirs, roms = scan_gamelist(gamelist_path)
+            except ET.ParseError as e:
+                # Without its references every file of the system would look orphaned, and it may point into other folders.
+                report["systems"][system_name] = {"error": f"gamelist.xml could not be parsed: {e}"}
+                scanned_dirs.add(os.path.normpath(os.path.join(system_dir, media_folder_name)))
+                delete_orphans = False
+                continue
+        referenced |= system_refs
+        # Media elsewhere (absolute paths, "../") counts as referenced but is not this collector's to delete.
+        media_dirs = {d for d in media_dirs if _within(base_dir, d)}
+        media_dirs.add(os.path.normpath(os.path.join(system_dir, media_folder_name)))
+        systems.append((system_name, gamelist_path, media_dirs, roms))
+
+    report["orphans_deleted"] = delete_orphans
+    for system_name, gamelist_path, media_dirs, roms in systems:
+        stats = {"orphans": 0, "orphan_bytes": 0, "stale_entries": 0}
+        for media_dir in sorted(media_dirs - scanned_dirs):
+            scanned_dirs.add(media_dir)  # a folder shared by several systems is scanned (and counted) once
+            try:
+                entries = list(os.scandir(media_dir))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_symlink():
+                    symlink_targets.add(os.path.normpath(os.path.join(media_dir, os.readlink(entry.path))))
+                if entry.path in referenced or not SCRAPER_MEDIA_RE.search(entry.name) or not entry.is_file(): continue
+                size = entry.stat(follow_symlinks=False).st_size
+                stats["orphans"] += 1; stats["orphan_bytes"] += size
+                if len(report["orphan_files"]) < REPORT_LIMIT:
+                    report["orphan_files"].append({"system": system_name, "path": entry.path, "size": size})
+                if delete_orphans:
+                    try: os.remove(entry.path)
+                    except OSError as e: print(f"Could not delete orphaned media {entry.path}: {e}")
+
+        stale = {xml_path for xml_path, rom_abs in roms if os.path.basename(rom_abs) not in _listing(os.path.dirname(rom_abs), listings)}
+        stats["stale_entries"] = len(stale)
+        report["stale_entries"].extend({"system": system_name, "rom_path": p} for p in sorted(stale)[:REPORT_LIMIT - len(report["stale_entries"])])
+        if stale and prune_entries and not dry_run:
+            _prune_entries(gamelist_path, stale)
+
+        if stats["orphans"] or stats["stale_entries"]:
+            report["systems"][system_name] = stats
+        report["orphan_count"] += stats["orphans"]; report["orphan_bytes"] += stats["orphan_bytes"]; report["stale_count"] += stats["stale_entries"]
+
+    if store_dir and os.path.isdir(store_dir):
+        # A blob whose only link is the store itself (and no symlink points to it) is used by no ROM any more.
+        sources = _processed_sources(processed_record_path, referenced) if processed_record_path else set()
+        for shard in os.scandir(store_dir):
+            if not shard.is_dir(): continue
+            for entry in os.scandir(shard.path):
+                st = entry.stat(follow_symlinks=False)
+                if entry.name.endswith(".part") or st.st_nlink > 1 or entry.path in symlink_targets: continue
+                if entry.name.split(".")[0] in sources: continue
+                report["store_count"] += 1; report["store_bytes"] += st.st_size
+                if len(report["store_blobs"]) < REPORT_LIMIT:
+                    report["store_blobs"].append({"path": entry.path, "size": st.st_size})
+                if include_store and not dry_run:
+                    try: os.remove(entry.path)
+                    except OSError as e: print(f"Could not delete store blob {entry.path}: {e}")
+
+    report["elapsed_ms"] = round((time.perf_counter() - started) * 1000)
+    return report
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Optional post-download stage: fits artwork to the frontend's display resolution, re-encodes it and strips metadata.
+import os, json, threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+FORMATS = {"PNG", "JPEG", "WEBP"}  # others (e.g. GIF) are recorded and left as they are
+
+def parse_resolution(text):
+    """(width, height) from "1280x720", None if empty or malformed."""
+    try:
+        width, height = (int(part) for part in str(text).lower().replace(" ", "").split("x"))
+        return (width, height) if width > 0 and height > 0 else None
+    except ValueError:
+        return None
+
+def process_image(path, max_size, quality):
+    """
+    Runs in a worker process. Shrinks the image at path to fit max_size, re-encodes it without metadata
+    and swaps the result in (path may be a hardlink into the media store, which must keep the original).
+    A result that was not resized and is not smaller is dropped. Returns (bytes before, bytes after, note).
+    """
+    before = os.path.getsize(path)
+    with Image.open(path) as source:
+        fmt = source.format
+        if fmt not in FORMATS or getattr(source, "n_frames", 1) > 1:
+            return before, before, "unsupported"
+        im = ImageOps.exif_transpose(source)  # apply the EXIF rotation before the tag is dropped
+        resized = im.width > max_size[0] or im.height > max_size[1]
+        if resized:
+            if im.mode == "P": im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+            im.thumbnail(max_size, Image.LANCZOS)
+        if fmt == "JPEG" and im.mode not in ("RGB", "L", "CMYK"): im = im.convert("RGB")
+        im.info = {k: v for k, v in im.info.items() if k == "transparency"}
+        tmp_path = f"{path}.pp"
+        if fmt == "PNG": im.save(tmp_path, "PNG", optimize=True)
+        elif fmt == "JPEG": im.save(tmp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+        else: im.save(tmp_path, "WEBP", quality=quality, method=6)
+    after = os.path.getsize(tmp_path)
+    if not resized and after >= before:
+        os.remove(tmp_path)
+        return before, before, "kept"
+    os.replace(tmp_path, path)
+    return before, after, "resized" if resized else "re-encoded"
+
+class MediaProcessor:
+    """
+    Runs process_image for downloaded artwork on a process pool, so the scrape goes on with its network work.
+    Every outcome is recorded in record_path (JSON, by path, with the size/mtime of the result and the
+    digests of the original), so a file is never processed twice and a processed file still counts as
+    matching ScreenScraper's checksum. Call finish() when a batch is done.
+    """
+    def __init__(self, record_path, max_size, quality=85, workers=None):
+        self.record_path, self.max_size, self.quality = record_path, max_size, quality
+        self.spec = f"{max_size[0]}x{max_size[1]}/q{quality}"
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)  # leave a core to the server and the scrape
+        # _outputs: {(st_dev, st_ino): path} of the files processed in this run, to recognise hardlinks to them
+        self._records, self._outputs, self._pending, self._pool, self._lock = {}, {}, {}, None, threading.Lock()
+        self.stats = {"processed": 0, "kept": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+        if record_path and os.path.exists(record_path):
+            try:
+                with open(record_path, "r", encoding="utf-8") as f: self._records = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable media processing record {record_path}: {e}")
+
+    def _current(self, path, st):
+        record = self._records.get(path)
+        return record if record and record["size"] == st.st_size and record["mtime_ns"] == st.st_mtime_ns and record["spec"] == self.spec else None
+
+    def source_digests(self, filepath):
+        """Digests of the original a processed file was made from, None if filepath is not such a file."""
+        path = os.path.abspath(filepath)
+        try: st = os.stat(path)
+        except OSError: return None
+        with self._lock:
+            record = self._current(path, st)
+        return record["source"] if record else None
+
+    def wants(self, filepath):
+        """True for an image that is neither processed nor queued (a hardlink to a processed file counts as processed)."""
+        path = os.path.abspath(filepath)
+        if os.path.splitext(path)[1].lower() not in IMAGE_EXTS: return False
+        try: st = os.stat(path)
+        except OSError: return False
+        with self._lock:
+            if path in self._pending or self._current(path, st): return False
+            output = self._outputs.get((st.st_dev, st.st_ino))
+            if output and self._current(output, st):
+                self._records[path] = dict(self._records[output])
+                return False
+        return True
+
+    def submit(self, filepath, source_digests):
+        """Queues filepath (see wants()); source_digests are recorded for checksum comparisons later on."""
+        path = os.path.abspath(filepath)
+        with self._lock:
+            if path in self._pending: return
+            if self._pool is None: self._pool = ProcessPoolExecutor(self.workers)
+            try:
+                future = self._pool.submit(process_image, path, self.max_size, self.quality)
+            except BrokenProcessPool as e:
+                print(f"Media processing pool failed, starting a new one: {e}")
+                self._pool = None  # a worker died (e.g. out of memory); the file is picked up on the next run
+                return
+            self._pending[path] = future
+        future.add_done_callback(lambda f: self._done(path, source_digests, f))
+
+    def _done(self, path, source_digests, future):
+        if future.cancelled() or isinstance(future.exception(), BrokenProcessPool):
+            with self._lock: self._pending.pop(path, None)  # not attempted, so not recorded either
+            return
+        try:
+            before, after, note = future.result()
+        except Exception as e:
+            before = after = None
+            note = f"failed: {e}"
+            print(f"Could not process {path}: {e}")
+            if os.path.exists(f"{path}.pp"): os.remove(f"{path}.pp")
+        with self._lock:
+            self._pending.pop(path, None)
+            try: st = os.stat(path)
+            except OSError: return
+            self._records[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "spec": self.spec, "source": source_digests, "result": note}
+            if note in ("resized", "re-encoded"):
+                self._outputs[(st.st_dev, st.st_ino)] = path
+                self.stats["processed"] += 1
+                self.stats["bytes_before"] += before; self.stats["bytes_after"] += after
+            else:
+                self.stats["failed" if before is None else "kept"] += 1
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def finish(self, cancel=False):
+        """Waits for the queued files (or drops those not started yet if cancel), stops the pool and saves the record."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool: pool.shutdown(wait=True, cancel_futures=cancel)
+        self.save()
+
+    def summary(self):
+        s = self.stats
+        return (f"{s['processed']} image(s) processed ({s['bytes_before'] / 2**20:.1f} MB -> {s['bytes_after'] / 2**20:.1f} MB), "
+                f"{s['kept']} left as they were, {s['failed']} failed")
+
+    def save(self):
+        if not self.record_path: return
+        with self._lock:
+            data = json.dumps(self._records)
+        try:
+            tmp_path = f"{self.record_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp_path, self.record_path)
+        except OSError as e:
+            print(f"Could not save media processing record: {e}")
+
+def create(record_path, settings):
+    """A MediaProcessor if the settings turn processing on and Pillow is installed, else None."""
+    if not settings.get("optimize_images") or Image is None: return None
+    max_size = parse_resolution(settings.get("display_resolution")) or (1280, 720)
+    try: quality = min(95, max(30, int(settings.get("image_quality") or 85)))
+    except ValueError: quality = 85
+    return MediaProcessor(record_path, max_size, quality)
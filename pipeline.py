@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Staged work pipeline: worker threads per stage, connected by bounded queues, with per-stage depth counters.
+import time, queue, threading
+
+HOLD = object()  # returned by a stage function: the item leaves the pipeline until it is fed again
+
+class Pipeline:
+    """
+    stages: [(name, fn, workers, queue_size)], queue_size None for 2 x workers. fn(item) does one stage's
+    work and returns the name of the stage the item goes to next (any stage, so steps can be skipped),
+    None when the item is finished, or HOLD. Every stage reads from its own bounded queue, so a slow
+    stage makes the ones before it wait instead of letting items pile up in memory. results() yields
+    finished items in completion order until everything fed is finished. on_error(item, exc) is called
+    when fn raises; the item is finished then.
+    """
+    def __init__(self, stages, on_error=None):
+        self.on_error = on_error
+        self._lock, self._open, self._out = threading.Lock(), 0, queue.Queue()
+        self._stages = {}
+        for name, fn, workers, queue_size in stages:
+            workers = max(1, int(workers))
+            self._stages[name] = {"fn": fn, "workers": workers, "queue": queue.Queue(queue_size or 2 * workers),
+                                  "active": 0, "done": 0, "busy_s": 0.0}
+            for i in range(workers):
+                threading.Thread(target=self._work, args=(name,), name=f"pipeline-{name}-{i}", daemon=True).start()
+        self.first = stages[0][0]
+
+    def feed(self, items, stage=None):
+        """Queues items at stage (the first by default) from a feeder thread, so callers never block on a full queue."""
+        items = list(items)
+        if not items: return
+        with self._lock:
+            self._open += len(items)  # counted now, so results() cannot see "all finished" before they are queued
+        self._put_later(stage or self.first, items)
+
+    def _put_later(self, stage, items):
+        stage_queue = self._stages[stage]["queue"]
+        threading.Thread(target=lambda: [stage_queue.put(item) for item in items], name="pipeline-feed", daemon=True).start()
+
+    def _work(self, name):
+        stage = self._stages[name]
+        while True:
+            item = stage["queue"].get()
+            if item is None: return
+            with self._lock: stage["active"] += 1
+            started = time.perf_counter()
+            try:
+                nxt = stage["fn"](item)
+            except Exception as e:
+                if self.on_error: self.on_error(item, e)
+                else: print(f"Pipeline stage '{name}' failed: {e}")
+                nxt = None
+            with self._lock:
+                stage["active"] -= 1; stage["done"] += 1
+                stage["busy_s"] += time.perf_counter() - started
+            if nxt is HOLD:
+                with self._lock:
+                    self._open -= 1
+                    if self._open == 0: self._out.put(HOLD)
+            elif nxt is None:
+                self._finish(item)
+            elif nxt == name:
+                self._put_later(name, [item])  # a worker must not wait for room in its own queue
+            else:
+                self._stages[nxt]["queue"].put(item)  # blocks while the next stage is full: backpressure
+
+    def _finish(self, item):
+        self._out.put(item)
+        with self._lock:
+            self._open -= 1
+            if self._open == 0: self._out.put(HOLD)  # wakes results() to check whether it is done
+
+    def results(self):
+        """Finished items until none is left in the pipeline; then the workers are stopped."""
+        try:
+            while True:
+                with self._lock:
+                    if self._open == 0 and self._out.empty(): return
+                item = self._out.get()
+                if item is not HOLD: yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the workers once they are done with what they hold (from a thread: a full queue must not block the caller)."""
+        def stop_workers():
+            for stage in self._stages.values():
+                for _ in range(stage["workers"]): stage["queue"].put(None)
+        threading.Thread(target=stop_workers, name="pipeline-close", daemon=True).start()
+
+    def snapshot(self):
+        """{stage: {"workers", "active", "queued", "capacity", "done", "busy_s"}} in stage order."""
+        with self._lock:
+            return {name: {"workers": s["workers"], "active": s["active"], "queued": s["queue"].qsize(), "capacity": s["queue"].maxsize,
+                           "done": s["done"], "busy_s": round(s["busy_s"], 2)} for name, s in self._stages.items()}
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Per-endpoint request timing/size histograms and an all-threads sampling profiler for the web server.
+import os, sys, time, bisect, threading
+from collections import Counter
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SIZE_BUCKETS = (1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20)
+MAX_ENDPOINTS = 200  # further endpoint names (e.g. random 404 paths) are counted as "other"
+MAX_PROFILE_SECONDS = 120
+
+def _percentile(buckets, counts, total, fraction):
+    """Upper bound of the bucket holding the given fraction of the samples (None past the last bucket)."""
+    seen = 0
+    for bound, count in zip(buckets, counts):
+        seen += count
+        if seen >= total * fraction: return bound
+    return None
+
+class RequestMetrics:
+    """
+    Latency and response-size histograms per (method, endpoint). Fixed buckets, so recording is a
+    bisect and a few increments under one lock and memory does not grow with the number of requests.
+    """
+    def __init__(self):
+        self._lock, self._started, self._endpoints = threading.Lock(), time.time(), {}
+
+    def record(self, method, endpoint, status, elapsed_ms, size):
+        with self._lock:
+            key = (method, endpoint) if (method, endpoint) in self._endpoints or len(self._endpoints) < MAX_ENDPOINTS else (method, "other")
+            entry = self._endpoints.get(key)
+            if entry is None:
+                entry = self._endpoints[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "bytes": 0, "max_bytes": 0,
+                    "latency": [0] * (len(LATENCY_BUCKETS_MS) + 1), "size": [0] * (len(SIZE_BUCKETS) + 1), "status": Counter()}
+            entry["count"] += 1; entry["total_ms"] += elapsed_ms; entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["bytes"] += size; entry["max_bytes"] = max(entry["max_bytes"], size)
+            entry["latency"][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            entry["size"][bisect.bisect_left(SIZE_BUCKETS, size)] += 1
+            entry["status"][f"{status // 100}xx" if status else "none"] += 1
+
+    def snapshot(self):
+        """JSON-ready report, slowest endpoints (by total time) first."""
+        with self._lock:
+            items = [(key, {**e, "latency": list(e["latency"]), "size": list(e["size"]), "status": dict(e["status"])}) for key, e in self._endpoints.items()]
+        endpoints = []
+        for (method, endpoint), e in sorted(items, key=lambda item: -item[1]["total_ms"]):
+            endpoints.append({"method": method, "endpoint": endpoint, "count": e["count"], "status": e["status"],
+                              "avg_ms": round(e["total_ms"] / e["count"], 2), "max_ms": round(e["max_ms"], 2),
+                              "p50_ms": _percentile(LATENCY_BUCKETS_MS, e["latency"], e["count"], 0.5),
+                              "p95_ms": _percentile(LATENCY_BUCKETS_MS, e["latency"], e["count"], 0.95),
+                              "p99_ms": _percentile(LATENCY_BUCKETS_MS, e["latency"], e["count"], 0.99),
+                              "avg_bytes": e["bytes"] // e["count"], "max_bytes": e["max_bytes"],
+                              "latency_histogram": dict(zip([f"<={b}" for b in LATENCY_BUCKETS_MS] + ["more"], e["latency"])),
+                              "size_histogram": dict(zip([f"<={b}" for b in SIZE_BUCKETS] + ["more"], e["size"]))})
+        return {"since": self._started, "endpoints": endpoints}
+
+    def reset(self):
+        with self._lock:
+            self._started, self._endpoints = time.time(), {}
+
+class CountingWriter:
+    """Wraps a handler's wfile and counts the bytes written through it."""
+    def __init__(self, raw):
+        self.raw, self.count = raw, 0
+    def write(self, data):
+        self.count += len(data)
+        return self.raw.write(data)
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+_profile_lock = threading.Lock()
+
+def sample_profile(seconds, interval=0.005):
+    """
+    Samples the stacks of all threads except the caller's every interval for the given seconds
+    (cProfile only sees the thread that enables it, which would miss the scrape and request threads).
+    Returns the folded stacks ("thread;outer;...;inner count" per line, for flamegraph.pl or speedscope)
+    followed by the 40 functions most often on top of a stack. Only one capture runs at a time.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already being captured.")
+    try:
+        own, stacks, leaves, samples = threading.get_ident(), Counter(), Counter(), 0
+        deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own: continue
+                leaves[f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})"] += 1
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks[";".join([names.get(ident, str(ident))] + functions[::-1])] += 1
+            samples += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+    lines += ["", f"# {samples} samples every {interval * 1000:g} ms; functions most often on top of a stack:"]
+    lines += [f"# {count:7d}  {leaf}" for leaf, count in leaves.most_common(40)]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Finds ROM files on disk, including those no gamelist.xml lists yet, with incremental re-scans.
+import os, json, threading
+
+# Folders that never hold ROMs: scraper output and the usual frontend media folders.
+SKIP_DIRS = {"downloaded_images", "downloaded_videos", "media", "images", "videos", "manuals", "snap", "snaps", "wheel", "box"}
+
+def load_extensions(path):
+    """{system: frozenset of lower-case extensions} from system_extensions.json; the "_default" entry covers other systems."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {system: frozenset(ext.lower() for ext in exts) for system, exts in json.load(f).items()}
+    except (OSError, ValueError) as e:
+        print(f"Could not read ROM extensions '{path}': {e}")
+        return {"_default": frozenset({".zip", ".7z"})}
+
+class RomScanner:
+    """
+    Walks system folders with os.scandir. Every directory's mtime is remembered together with the ROMs
+    and sub-directories found in it; on a re-scan an unchanged directory is not listed again, only its
+    sub-directories are stat'ed. A directory whose own name has a ROM extension (e.g. "game.daphne") is
+    a ROM. The state is persisted as JSON to state_path (in memory only if None).
+    """
+    def __init__(self, extensions, state_path=None, skip_dirs=()):
+        self.extensions, self.state_path = extensions, state_path
+        self.skip_dirs = {d.lower() for d in SKIP_DIRS | set(skip_dirs)}
+        self._dirs, self._dirty, self._lock = {}, False, threading.Lock()
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f: self._dirs = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable ROM scan state {state_path}: {e}")
+
+    def extensions_for(self, system_name):
+        return self.extensions.get(system_name) or self.extensions.get("_default", frozenset())
+
+    def scan(self, base_dir, system_name):
+        """ROM paths of a system in gamelist form ("./sub/game.zip"), sorted."""
+        system_dir = os.path.join(base_dir, system_name)
+        exts, roms = self.extensions_for(system_name), []
+        pending = [(system_dir, ".")]
+        while pending:
+            directory, rel_dir = pending.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            with self._lock:
+                cached = self._dirs.get(directory)
+            if cached and cached[0] == mtime_ns:
+                files, subdirs = cached[1], cached[2]
+            else:
+                files, subdirs = self._list(directory, exts)
+                with self._lock:
+                    self._dirs[directory], self._dirty = [mtime_ns, files, subdirs], True
+            roms.extend(f"{rel_dir}/{name}" for name in files)
+            pending.extend((os.path.join(directory, name), f"{rel_dir}/{name}") for name in subdirs)
+        return sorted(roms)
+
+    def _list(self, directory, exts):
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith("."): continue
+                    is_rom = os.path.splitext(entry.name)[1].lower() in exts
+                    if entry.is_dir():
+                        if is_rom: files.append(entry.name)
+                        elif entry.name.lower() not in self.skip_dirs: subdirs.append(entry.name)
+                    elif is_rom:
+                        files.append(entry.name)
+        except OSError as e:
+            print(f"Could not scan {directory}: {e}")
+        return sorted(files), sorted(subdirs)
+
+    def save(self):
+        if not self.state_path or not self._dirty: return
+        with self._lock:
+            data, self._dirty = json.dumps(self._dirs), False
+        try:
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            print(f"Could not save ROM scan state: {e}")
@@ -1,12 +1,19 @@
 ﻿# -*- coding: utf-8 -*-
 # Version: FINAL (Cleaned, no debug output)
-import os, hashlib, requests, csv, configparser, xml.etree.ElementTree as ET, base64, json, argparse, uuid, re
+import os, sys, hashlib, requests, csv, xml.etree.ElementTree as ET, json, argparse, uuid, re, threading, zlib, time, shutil, collections, functools, itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from urllib.parse import urlparse, parse_qsl, urlencode
+import rom_discovery, settings_store, media_postprocess, gamelist_io, pipeline
 
 # --- Constants ---
 BASE_ROM_PATH, MEDIA_FOLDER, GAMELIST_XML = "/rcade/share/roms", "downloaded_images", "gamelist.xml"
 SCREENSCRAPER_API = "https://www.screenscraper.fr/api2/jeuInfos.php"
+SCREENSCRAPER_USER_API = "https://www.screenscraper.fr/api2/ssuserInfos.php"
 SYSTEM_ID_MAP = {}
+# Query parameters of ScreenScraper media URLs that identify the caller, not the file.
+CREDENTIAL_PARAMS = {"devid", "devpassword", "ssid", "sspassword", "softname", "output"}
 
 def guess_game_titles_with_gemini(filename, api_key):
     # Use Google Gemini API, to guess game name.
@@ -47,36 +54,24 @@ def append_to_alt_romnames(csv_path, src_romname, alt_name, src_system):
         return f"[ERROR] Could not write to alt_rom_names.csv: {e}"
 		
 def log_error(message):
-    print(f"[ERROR-LOG] {message}")
-
-def decode_if_base64(s):
-    try:
-        if isinstance(s, str) and (any(c in s for c in ['=','/','+']) or len(s)%4==0):
-            decoded = base64.b64decode(s.encode()).decode("utf-8")
-            if decoded.isalnum() or "@" in decoded or decoded.startswith("sk-or-"): return decoded
-        return s
-    except Exception: return s
-
-def read_config(cfg_path):
-    config = configparser.ConfigParser()
-    config.read(cfg_path, encoding="utf-8")
-    creds = {"devid": "", "devpassword": "", "ssid": "", "sspassword": "", "lang": "en"}
-    if "credentials" in config:
-        for key in creds:
-            creds[key] = decode_if_base64(config["credentials"].get(key, creds[key]))
-    return creds
+    print(f"[ERROR-LOG] {message}", file=sys.stderr)
 
 def download_media(url, dest):
     if not url: return None, "[FAIL] No URL provided to download."
     os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if cache_peer and cache_peer.fetch_media(url, dest):
+        return dest, f"[PEER] Saved from peer cabinet: {os.path.basename(dest)}"
     try:
         r = requests.get(url, stream=True, timeout=15)
         r.raise_for_status()
         content_type = r.headers.get('content-type', '')
         if 'text/html' in content_type:
             return None, f"[FAIL] Received HTML instead of media for: {os.path.basename(dest)}"
-        with open(dest, "wb") as f:
+        # Write next to dest and swap it in: dest may be a hardlink shared with other ROMs.
+        tmp_path = f"{dest}.part"
+        with open(tmp_path, "wb") as f:
             for chunk in r.iter_content(1024): f.write(chunk)
+        os.replace(tmp_path, dest)
         return dest, f"[SUCCESS] Saved: {os.path.basename(dest)}"
     except requests.exceptions.RequestException as e:
         status_code = e.response.status_code if e.response is not None else "N/A"
@@ -86,6 +81,503 @@ def download_media(url, dest):
     except Exception as e:
         return None, f"[FAIL] Exception downloading media: {e}"
 
+def media_url_key(url):
+    """Stable cache key for a media URL: SHA1 of the URL without credential parameters."""
+    parsed = urlparse(url)
+    params = sorted((k, v) for k, v in parse_qsl(parsed.query) if k not in CREDENTIAL_PARAMS)
+    return hashlib.sha1(f"{parsed.netloc}{parsed.path}?{urlencode(params)}".encode("utf-8")).hexdigest()
+
+def set_media_credentials(jeu, credentials):
+    """Replaces the credential parameters of every media URL in jeu with credentials ({} strips them)."""
+    medias = jeu.get("medias", [])
+    for item in medias if isinstance(medias, list) else [medias]:
+        if isinstance(item, dict) and item.get("url"):
+            parsed = urlparse(item["url"])
+            query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k not in CREDENTIAL_PARAMS]
+            item["url"] = parsed._replace(query=urlencode(query + list(credentials.items()))).geturl()
+    return jeu
+
+class ResponseCache:
+    """
+    Successful jeuInfos answers on disk as <cache_dir>/<key[:2]>/<key>.json (see response_key), stripped
+    to the "jeu" object and without credentials in the media URLs, so no account data is kept or shared.
+    Answers older than max_age_days are looked up again.
+    """
+    def __init__(self, cache_dir, max_age_days=30):
+        self.cache_dir, self.max_age = cache_dir, max_age_days * 86400
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def raw(self, key):
+        """The stored JSON bytes of key, or None if missing or expired."""
+        path = self.path_for(key)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.max_age: return None
+            with open(path, "rb") as f: return f.read()
+        except OSError:
+            return None
+
+    def get(self, key):
+        body = self.raw(key)
+        try: return json.loads(body) if body else None
+        except ValueError: return None
+
+    def put(self, key, data):
+        path = self.path_for(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+            jeu = set_media_credentials(json.loads(json.dumps(data["response"]["jeu"])), {})
+            with open(tmp_path, "w", encoding="utf-8") as f: json.dump({"response": {"jeu": jeu}}, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log_error(f"Could not cache the response {key}: {e}")
+
+response_cache = None  # a ResponseCache when set up by the server or the CLI
+
+def response_key(params):
+    """Cache key of a jeuInfos lookup: SHA1 over its parameters without credentials (same on every cabinet)."""
+    return hashlib.sha1(urlencode(sorted((k, v) for k, v in params.items() if k not in CREDENTIAL_PARAMS)).encode("utf-8")).hexdigest()
+
+class CachePeer:
+    """
+    Another cabinet's scraper server with "Share cache with other cabinets" on. Lookups and media are
+    asked there before screenscraper.fr; every body must hash to the X-Content-SHA1 header it came with.
+    An unreachable peer is skipped for retry_delay seconds, so a switched-off cabinet costs one timeout.
+    """
+    def __init__(self, base_url, timeout=3, retry_delay=120):
+        self.base_url, self.timeout, self.retry_delay = base_url.rstrip("/"), timeout, retry_delay
+        self.stats, self._down_until = {"responses": 0, "media": 0, "bytes": 0, "rejected": 0}, 0
+
+    def _get(self, path, key, **kwargs):
+        if time.time() < self._down_until: return None
+        try:
+            r = requests.get(f"{self.base_url}{path}", params={"key": key}, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            log_error(f"Cache peer {self.base_url} unreachable: {e}")
+            self._down_until = time.time() + self.retry_delay
+            return None
+        if r.status_code != 200 or not r.headers.get("X-Content-SHA1"):
+            r.close()
+            return None
+        return r
+
+    def response(self, key):
+        r = self._get("/peer/response", key)
+        if r is None: return None
+        if hashlib.sha1(r.content).hexdigest() != r.headers["X-Content-SHA1"]:
+            self.stats["rejected"] += 1
+            return None
+        try: data = r.json()
+        except ValueError: return None
+        if not isinstance(data.get("response", {}).get("jeu"), dict): return None
+        self.stats["responses"] += 1
+        return data
+
+    def fetch_media(self, url, dest):
+        """Saves the peer's stored file for url at dest. Returns False if the peer has none or it failed verification."""
+        r = self._get("/peer/media", media_url_key(url), stream=True)
+        if r is None: return False
+        tmp_path, digest, size = f"{dest}.{uuid.uuid4().hex}.part", hashlib.sha1(), 0
+        try:
+            with r, open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(65536):
+                    digest.update(chunk); f.write(chunk); size += len(chunk)
+            if digest.hexdigest() != r.headers["X-Content-SHA1"]:
+                self.stats["rejected"] += 1
+                os.remove(tmp_path)
+                return False
+            os.replace(tmp_path, dest)
+        except (OSError, requests.exceptions.RequestException) as e:
+            log_error(f"Download from cache peer failed: {e}")
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            return False
+        self.stats["media"] += 1; self.stats["bytes"] += size
+        return True
+
+cache_peer = None  # a CachePeer when a peer cabinet is configured
+
+class MediaCache:
+    """
+    Media files cached on disk by URL (see media_url_key), shared by all diagnose sessions.
+    At most max_concurrent downloads run at once, the same URL is never fetched twice in
+    parallel, and the oldest files are evicted once the cache grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=256 * 2**20, max_concurrent=3):
+        self.cache_dir, self.max_bytes = cache_dir, max_bytes
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._locks, self._locks_guard = {}, threading.Lock()
+
+    def path_for(self, url, ext):
+        return os.path.join(self.cache_dir, f"{media_url_key(url)}.{ext}")
+
+    def get(self, url, ext):
+        """Returns (path, log message); path is None if the download failed."""
+        dest = self.path_for(url, ext)
+        with self._locks_guard:
+            lock = self._locks.setdefault(dest, threading.Lock())
+        with lock:
+            if os.path.exists(dest):
+                os.utime(dest)
+                return dest, f"[CACHE] Reused: {os.path.basename(dest)}"
+            with self._slots:
+                tmp_path, log_msg = download_media(url, f"{dest}.{uuid.uuid4().hex}.part")
+            if tmp_path is None:
+                return None, log_msg
+            os.replace(tmp_path, dest)
+        self._evict()
+        return dest, log_msg
+
+    def _evict(self):
+        try:
+            entries = sorted((e for e in os.scandir(self.cache_dir) if e.is_file() and not e.name.endswith(".part")), key=lambda e: e.stat().st_mtime)
+            total = sum(e.stat().st_size for e in entries)
+            for entry in entries:
+                if total <= self.max_bytes: break
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+        except OSError as e:
+            log_error(f"Media cache eviction failed: {e}")
+
+# Lighter variants ScreenScraper offers for some media types, used when "prefer_light_variants" is on.
+LIGHT_VARIANTS = {"video": "video-normalized"}
+DEFAULT_PREFERRED_REGIONS = settings_store.SCHEMA["media_selection"]["preferred_regions"]
+
+def _int(value, default=0):
+    try: return int(value)
+    except (TypeError, ValueError): return default
+
+def _float(value, default=0.0):
+    try: return float(value)
+    except (TypeError, ValueError): return default
+
+def _is_true(value):
+    return str(value).strip().lower() == "true"
+
+def parse_resolution(value):
+    """'1920x1080' -> (1920, 1080). None for empty or malformed values (no cap)."""
+    match = re.match(r'^\s*(\d+)\s*[xX*]\s*(\d+)\s*$', str(value or ""))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def _within_caps(item, max_bytes, max_resolution):
+    size, width, height = _int(item.get("size")), _int(item.get("width")), _int(item.get("height"))
+    if max_bytes and size and size > max_bytes: return False
+    if max_resolution and width and height:
+        # Compared orientation-independent, so a portrait box art is not rejected by a landscape cap.
+        if max(width, height) > max(max_resolution) or min(width, height) > min(max_resolution): return False
+    return True
+
+def select_media(options, target_type, flags):
+    """
+    Picks one media item for a gamelist media type. In order: lighter variants (e.g.
+    video-normalized) if preferred and available, items within the per-type byte and resolution
+    caps (the lightest item if none fits), the best-ranked region of "preferred_regions", then
+    the configured strategy_for_<type>.
+    """
+    if not options: return None
+    light_type = LIGHT_VARIANTS.get(target_type)
+    if light_type:
+        light = [o for o in options if o.get("type") == light_type]
+        regular = [o for o in options if o.get("type") != light_type]
+        options = light if light and _is_true(flags.get("prefer_light_variants", True)) else (regular or light)
+
+    max_bytes = int(float(flags.get(f"max_size_mb_for_{target_type}", 0) or 0) * 2**20)
+    max_resolution = parse_resolution(flags.get(f"max_resolution_for_{target_type}"))
+    fitting = [o for o in options if _within_caps(o, max_bytes, max_resolution)]
+    if not fitting:
+        lightest = min(options, key=lambda x: (_int(x.get("size")) or float("inf"), _int(x.get("width")) * _int(x.get("height"))))
+        fitting = [lightest]
+
+    regions = [r.strip().lower() for r in str(flags.get("preferred_regions", DEFAULT_PREFERRED_REGIONS)).split(",") if r.strip()]
+    if regions:
+        rank = lambda x: regions.index(str(x.get("region", "")).lower()) if str(x.get("region", "")).lower() in regions else len(regions)
+        best_rank = min(rank(o) for o in fitting)
+        fitting = [o for o in fitting if rank(o) == best_rank]
+
+    strategy = flags.get(f"strategy_for_{target_type}", "best_resolution")
+    if strategy == "first":
+        return fitting[0]
+    elif strategy == "last":
+        return fitting[-1]
+    elif strategy == "largest_size":
+        return max(fitting, key=lambda x: _int(x.get('size')))
+    elif strategy == "smallest_size":
+        return min(fitting, key=lambda x: _int(x.get('size')))
+    return max(fitting, key=lambda x: _int(x.get('width')) * _int(x.get('height')))
+
+# ScreenScraper media checksum fields, strongest first.
+CHECKSUM_FIELDS = ("sha1", "md5", "crc")
+
+def file_digests(filepath):
+    """sha1, md5 and crc (8 hex digits) of a file, computed in one read."""
+    sha1, md5, crc = hashlib.sha1(), hashlib.md5(), 0
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha1.update(chunk); md5.update(chunk); crc = zlib.crc32(chunk, crc)
+    return {"sha1": sha1.hexdigest(), "md5": md5.hexdigest(), "crc": f"{crc & 0xffffffff:08x}"}
+
+class MediaDigestCache:
+    """
+    Digests of local media files, keyed by absolute path and reused while size and mtime are unchanged,
+    so comparing against ScreenScraper's crc/md5/sha1 costs one hash per file, not one per scrape.
+    Persisted as JSON to cache_path (in memory only if None); call save() when a batch is done.
+    """
+    def __init__(self, cache_path=None):
+        self.cache_path, self._entries, self._dirty, self._lock = cache_path, {}, 0, threading.Lock()
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f: self._entries = json.load(f)
+            except Exception as e:
+                log_error(f"Could not read media digest cache '{cache_path}': {e}")
+
+    def digests(self, filepath):
+        path = os.path.abspath(filepath)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["digests"]
+        return self.remember(path, file_digests(path), st)
+
+    def remember(self, filepath, digests, st=None):
+        """Records digests computed elsewhere (e.g. while storing a download) for filepath as it is now."""
+        path = os.path.abspath(filepath)
+        st = st or os.stat(path)
+        with self._lock:
+            self._entries[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "digests": digests}
+            self._dirty += 1
+        if self._dirty >= 100: self.save()
+        return digests
+
+    def matches(self, filepath, media_item):
+        """True/False if the local file does/doesn't match the item's checksum, None if the item has none."""
+        if media_processor:
+            # A post-processed file is compared by the original it was made from.
+            source = media_processor.source_digests(filepath)
+            if source: return checksum_matches(media_item, lambda: source)
+        return checksum_matches(media_item, lambda: self.digests(filepath))
+
+    def save(self):
+        if not self.cache_path or not self._dirty: return
+        with self._lock:
+            data, self._dirty = json.dumps(self._entries), 0
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            log_error(f"Could not save media digest cache: {e}")
+
+def checksum_matches(media_item, get_digests):
+    """Compares the item's first checksum field with get_digests() (only called if it has one); None without checksum."""
+    for field in CHECKSUM_FIELDS:
+        expected = str(media_item.get(field) or "").strip().lower()
+        if expected:
+            return get_digests()[field] == (expected.zfill(8) if field == "crc" else expected)
+    return None
+
+media_digests = MediaDigestCache()
+media_processor = None  # a media_postprocess.MediaProcessor while a batch runs with image optimization on
+
+def postprocess_media(path):
+    """Queues a placed media file for media_processor, if one is set up and the file still needs it."""
+    if media_processor and media_processor.wants(path):
+        media_processor.submit(path, media_digests.digests(path))
+
+def load_clone_index(dat_path):
+    """{clone: parent} from a MAME -listxml or Logiqx DAT file (<machine>/<game> elements with a cloneof attribute)."""
+    clones = {}
+    for _, el in ET.iterparse(dat_path):
+        if el.tag in ("machine", "game"):
+            if el.get("cloneof"): clones[el.get("name")] = el.get("cloneof")
+            el.clear()
+    return clones
+
+def link_media(src, dest):
+    """Hardlinks src to dest (replacing dest). Returns False where hardlinks are not supported, e.g. FAT/exFAT."""
+    tmp_path = f"{dest}.link"
+    try:
+        if os.path.exists(dest) and os.path.samefile(src, dest): return True
+        if os.path.lexists(tmp_path): os.remove(tmp_path)
+        os.link(src, tmp_path)
+        os.replace(tmp_path, dest)
+        return True
+    except OSError:
+        return False
+
+def place_media(src, dest):
+    """Puts src at dest as a hardlink, else a relative symlink, else a copy. Returns which one was made."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if link_media(src, dest): return "hardlink"
+    tmp_path = f"{dest}.link"
+    try:
+        if os.path.lexists(tmp_path): os.remove(tmp_path)
+        os.symlink(os.path.relpath(src, os.path.dirname(dest)), tmp_path)
+        os.replace(tmp_path, dest)
+        return "symlink"
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+        return "copy"
+
+class MediaShare:
+    """
+    Per-run registry that lets clones and regional duplicates share one lookup and one copy of each media file.
+    ScreenScraper matches are remembered per parent set (from dat_dir/<system>.xml or .dat, a MAME -listxml or
+    Logiqx DAT), downloaded files per ScreenScraper game id, media type and URL.
+    """
+    def __init__(self, dat_dir=None):
+        self.dat_dir, self._clone_indexes, self._matches, self._media, self._lock = dat_dir, {}, {}, {}, threading.Lock()
+
+    def parent_of(self, system_name, romname):
+        with self._lock:
+            if system_name not in self._clone_indexes:
+                self._clone_indexes[system_name] = {}
+                for ext in ("xml", "dat"):
+                    dat_path = os.path.join(self.dat_dir, f"{system_name}.{ext}") if self.dat_dir else None
+                    if dat_path and os.path.exists(dat_path):
+                        try: self._clone_indexes[system_name] = load_clone_index(dat_path)
+                        except (ET.ParseError, OSError) as e: log_error(f"Could not read clone index '{dat_path}': {e}")
+                        break
+            return self._clone_indexes[system_name].get(romname)
+
+    def match_for(self, system_name, romname):
+        """(set name, data) of a match already made in this run for the same parent set, else None."""
+        parent = self.parent_of(system_name, romname) or romname
+        with self._lock:
+            return self._matches.get((system_name, parent))
+
+    def remember_match(self, system_name, romname, data):
+        parent = self.parent_of(system_name, romname) or romname
+        with self._lock:
+            self._matches.setdefault((system_name, parent), (romname, data))
+
+    def _media_key(self, data, target_type, media_item):
+        game_id = data["response"]["jeu"].get("id")
+        return (game_id, target_type, media_url_key(media_item.get("url", ""))) if game_id else None
+
+    def media_for(self, data, target_type, media_item):
+        key = self._media_key(data, target_type, media_item)
+        with self._lock:
+            path = self._media.get(key) if key else None
+        return path if path and os.path.exists(path) else None
+
+    def remember_media(self, data, target_type, media_item, path):
+        key = self._media_key(data, target_type, media_item)
+        if key:
+            with self._lock: self._media.setdefault(key, path)
+
+media_share = MediaShare()
+
+class MediaStore:
+    """
+    Content-addressed media store: each file is kept once as <store_dir>/<sha1[:2]>/<sha1>.<ext> and placed
+    at its per-ROM name with place_media(). index.json maps media URLs (media_url_key) to blobs, so a file
+    that is already on the stick is never downloaded again. Where files can only be copied (FAT/exFAT), the
+    placed file itself is indexed (by absolute path) instead of keeping a second copy in the store.
+    Call save() when a batch is done.
+    """
+    def __init__(self, store_dir):
+        self.store_dir, self.index_path = store_dir, os.path.join(store_dir, "index.json")
+        self._index, self._dirty, self._lock = {}, 0, threading.Lock()
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f: self._index = json.load(f)
+            except Exception as e:
+                log_error(f"Could not read media store index '{self.index_path}': {e}")
+
+    def blob_for(self, url):
+        return self.blob_for_key(media_url_key(url))
+
+    def blob_for_key(self, url_key):
+        with self._lock:
+            name = self._index.get(url_key)
+        blob = os.path.join(self.store_dir, name) if name else None
+        return blob if blob and os.path.exists(blob) else None
+
+    def _index_as(self, url, name):
+        if not url: return
+        with self._lock:
+            self._index[media_url_key(url)] = name
+            self._dirty += 1
+
+    def _forget(self, url, blob, corrupt=False):
+        """Drops url from the index; its blob goes too if it is corrupt or no other URL uses it (never a file indexed in place)."""
+        name = os.path.relpath(blob, self.store_dir).replace(os.sep, "/")
+        with self._lock:
+            if url:
+                self._index.pop(media_url_key(url), None)
+                self._dirty += 1
+            unused = name not in self._index.values()
+        if (corrupt or unused) and not name.startswith("..") and os.path.exists(blob):
+            os.remove(blob)
+
+    def _commit(self, path, url, ext, move, digest):
+        """Files path under its content hash digest (moving or hardlinking it) and indexes it under url. Returns the blob path."""
+        name = f"{digest[:2]}/{digest}.{ext}"
+        blob = os.path.join(self.store_dir, name)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            if move: os.remove(path)
+        elif move:
+            os.replace(path, blob)
+        elif not link_media(path, blob):
+            # No hardlinks here: index the file where it is rather than storing a second copy.
+            name = blob = os.path.abspath(path)
+        self._index_as(url, name)
+        return blob
+
+    def add_file(self, path, url=None):
+        """Adopts an existing local file (e.g. one that matched ScreenScraper's checksum). Returns the blob path."""
+        # The sha1 comes from the digest cache, which the checksum comparison has usually just filled.
+        return self._commit(path, url, Path(path).suffix.lstrip(".") or "dat", move=False, digest=media_digests.digests(path)["sha1"])
+
+    def fetch(self, url, dest, media_item=None):
+        """
+        Places the media of url at dest, downloading it only if the store does not have it. A stored file that
+        does not match media_item's checksum (outdated or corrupt) is dropped and downloaded again.
+        Returns (path, log message).
+        """
+        blob, note = self.blob_for(url), ""
+        if blob and media_processor and media_processor.source_digests(blob):
+            # A file indexed in place was optimized since: it is no longer the original of url.
+            self._forget(url, blob)
+            blob = None
+        if blob and media_item and media_digests.matches(blob, media_item) is False:
+            self._forget(url, blob, corrupt=media_digests.digests(blob)["sha1"] not in os.path.basename(blob))
+            blob, note = None, " (stored copy failed the checksum)"
+        if blob:
+            how = place_media(blob, dest)
+            return dest, f"[STORE] Reused stored file ({how}): {os.path.basename(dest)}"
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path, log_msg = download_media(url, os.path.join(self.store_dir, f"{uuid.uuid4().hex}.part"))
+        if tmp_path is None:
+            return None, log_msg
+        # One read for all digests: the checksum comparison after the download then finds dest in the digest cache.
+        digests = file_digests(tmp_path)
+        blob = self._commit(tmp_path, url, Path(dest).suffix.lstrip(".") or "dat", move=True, digest=digests["sha1"])
+        if place_media(blob, dest) == "copy":
+            # No links on this filesystem: keep dest as the stored copy rather than the file twice.
+            self._index_as(url, os.path.abspath(dest))
+            self._forget(None, blob)
+        media_digests.remember(dest, digests)
+        return dest, f"{'[PEER] Saved from peer cabinet' if log_msg.startswith('[PEER]') else '[SUCCESS] Saved'}{note}: {os.path.basename(dest)}"
+
+    def save(self):
+        if not self._dirty: return
+        with self._lock:
+            data, self._dirty = json.dumps(self._index), 0
+        try:
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f: f.write(data)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            log_error(f"Could not save media store index: {e}")
+
+media_store = None  # a MediaStore when set up by the server or the CLI; plain downloads otherwise
+
 def sha1_hash(filepath):
     h = hashlib.sha1()
     with open(filepath, "rb") as f:
@@ -114,25 +606,23 @@ def load_alt_romnames(csv_path):
     except Exception as e: print(f"[ERROR] Could not read alt rom names CSV '{csv_path}': {e}")
     return mappings
 
+_gamelist_locks, _gamelist_locks_guard = {}, threading.Lock()
+
 def update_gamelist(gamelist_path, entry_data, force=False):
-    try:
-        tree = ET.parse(gamelist_path) if os.path.exists(gamelist_path) else ET.ElementTree(ET.Element("gameList"))
-        root = tree.getroot()
-        game_el = None
-        if 'rom_path' in entry_data:
-            for node in root.findall("game"):
-                if node.get("path") == entry_data['rom_path']:
-                    game_el = node
-                    break
-        if game_el is None and 'rom_path' in entry_data:
-            game_el = ET.SubElement(root, "game", path=entry_data["rom_path"])
-        elif game_el is None:
-            return
-        def update_tag(parent, tag_name, text):
-            if text is None: return
-            el = parent.find(tag_name)
-            if el is None: el = ET.SubElement(parent, tag_name)
-            el.text = str(text)
+    # Rewrites the whole file (streamed, see gamelist_io.rewrite), so parallel scrapes of one system take turns per gamelist.
+    with _gamelist_locks_guard:
+        lock = _gamelist_locks.setdefault(os.path.abspath(gamelist_path), threading.Lock())
+    with lock:
+        _update_gamelist(gamelist_path, entry_data, force)
+
+def _update_gamelist(gamelist_path, entry_data, force):
+    if 'rom_path' not in entry_data: return
+    def update_tag(parent, tag_name, text):
+        if text is None: return
+        el = parent.find(tag_name)
+        if el is None: el = ET.SubElement(parent, tag_name)
+        el.text = str(text)
+    def update_game(game_el):
         media_keys = {"image_path": "image", "video_path": "video", "thumbnail_path": "thumbnail", "marquee_path": "marquee"}
         for data_key, xml_tag_name in media_keys.items():
             if data_key in entry_data:
@@ -143,10 +633,173 @@ def update_gamelist(gamelist_path, entry_data, force=False):
             for data_key, xml_tag_name in metadata_keys.items():
                 if data_key in entry_data:
                     update_tag(game_el, xml_tag_name, entry_data[data_key])
-        tree.write(gamelist_path, encoding="utf-8", xml_declaration=True)
+    found = []
+    def edit(node):
+        if not found and node.tag == "game" and node.get("path") == entry_data['rom_path']:
+            update_game(node)
+            found.append(node)
+    def append():
+        if found: return []
+        game_el = ET.Element("game", path=entry_data["rom_path"])
+        update_game(game_el)
+        return [game_el]
+    try:
+        gamelist_io.rewrite(gamelist_path, edit, append)
     except Exception as e:
         log_error(f"Failed to update gamelist.xml for {entry_data.get('rom_path', 'N/A')}: {e}")
 
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("Europe/Paris")  # ScreenScraper resets its daily counters at midnight, French time.
+except Exception:
+    QUOTA_TIMEZONE = timezone(timedelta(hours=1))
+
+class QuotaExhausted(Exception):
+    """Raised by query_screenscraper() instead of calling the API once the daily budget is spent."""
+
+class ApiQuota:
+    """
+    Daily ScreenScraper request budget. Counters come from ssuserInfos.php (refresh()) and are
+    tracked locally for every jeuInfos call in between; "ko" are lookups that found nothing, which
+    ScreenScraper caps separately. A reserve of requests is kept back for the dashboard.
+    Persisted as JSON to state_path (in memory only if None).
+    """
+    def __init__(self, state_path=None, reserve=20):
+        self.state_path, self.reserve, self._lock = state_path, reserve, threading.Lock()
+        self.state = {"day": self._today(), "requests": 0, "max_requests": 0, "ko": 0, "max_ko": 0, "max_threads": 0}
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f: self.state.update(json.load(f))
+            except Exception as e:
+                log_error(f"Could not read quota state '{state_path}': {e}")
+        self._roll_over()
+
+    @staticmethod
+    def _today():
+        return datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+    def _roll_over(self):
+        if self.state["day"] != self._today():
+            self.state.update({"day": self._today(), "requests": 0, "ko": 0})
+
+    def refresh(self, creds):
+        """Reads the server-side counters. Returns False if they could not be fetched (local counting continues)."""
+        params = {"devid": creds.get("devid", ""), "devpassword": creds.get("devpassword", ""), "ssid": creds.get("ssid", ""),
+                  "sspassword": creds.get("sspassword", ""), "softname": "lite_scraper_v2_module", "output": "json"}
+        try:
+            r = requests.get(SCREENSCRAPER_USER_API, params=params, timeout=10)
+            r.raise_for_status()
+            user = r.json().get("response", {}).get("ssuser", {})
+        except Exception as e:
+            log_error(f"Could not read ScreenScraper quota: {e}")
+            return False
+        with self._lock:
+            self._roll_over()
+            self.state.update({"requests": _int(user.get("requeststoday")), "max_requests": _int(user.get("maxrequestsperday")),
+                               "ko": _int(user.get("requestskotoday")), "max_ko": _int(user.get("maxrequestskoperday")),
+                               "max_threads": _int(user.get("maxthreads"))})
+        self.save()
+        return True
+
+    def remaining(self):
+        with self._lock:
+            self._roll_over()
+            if not self.state["max_requests"]: return None  # unknown: never block
+            left = self.state["max_requests"] - self.state["requests"] - self.reserve
+            if self.state["max_ko"]:
+                left = min(left, self.state["max_ko"] - self.state["ko"])
+            return max(0, left)
+
+    def check(self):
+        if self.remaining() == 0:
+            raise QuotaExhausted(f"Daily ScreenScraper quota reached ({self.state['requests']}/{self.state['max_requests']} requests).")
+
+    def record(self, found):
+        with self._lock:
+            self._roll_over()
+            self.state["requests"] += 1
+            if not found: self.state["ko"] += 1
+
+    def mark_exhausted(self):
+        with self._lock:
+            self.state["requests"] = max(self.state["requests"], self.state["max_requests"] or 1)
+            self.state["max_requests"] = self.state["max_requests"] or 1
+
+    def seconds_until_reset(self):
+        now = datetime.now(QUOTA_TIMEZONE)
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=30, microsecond=0)
+        return max(0, (midnight - now).total_seconds())
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.state, "reserve": self.reserve}
+
+    def save(self):
+        if not self.state_path: return
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, "w", encoding="utf-8") as f: json.dump(self.snapshot(), f)
+        except Exception as e:
+            log_error(f"Could not save quota state: {e}")
+
+api_quota = ApiQuota()
+
+class ApiUnavailable(Exception):
+    """Raised by query_screenscraper() while the circuit breaker is open, so callers pause instead of failing ROMs."""
+    def __init__(self, message, retry_at):
+        super().__init__(message)
+        self.retry_at = retry_at
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive timeouts/connection errors/5xx answers. While open every
+    call fails fast; after the backoff delay one probe request is let through (half-open). A failed
+    probe reopens the breaker with the delay doubled, up to max_delay.
+    """
+    def __init__(self, threshold=3, base_delay=30, max_delay=900):
+        self.threshold, self.base_delay, self.max_delay = threshold, base_delay, max_delay
+        self.failures, self.delay, self.retry_at, self.probing = 0, base_delay, 0.0, False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def before_request(self):
+        with self._lock:
+            if not self.is_open: return
+            if self.probing or time.time() < self.retry_at:
+                raise ApiUnavailable("ScreenScraper is unavailable.", self.retry_at)
+            self.probing = True  # half-open: this caller is the probe
+
+    def record_success(self):
+        with self._lock:
+            self.failures, self.delay, self.probing = 0, self.base_delay, False
+
+    def record_failure(self):
+        with self._lock:
+            if self.probing:
+                self.delay = min(self.delay * 2, self.max_delay)
+            self.failures += 1
+            self.probing = False
+            if self.is_open:
+                self.retry_at = time.time() + self.delay
+            return self.is_open
+
+    def snapshot(self):
+        with self._lock:
+            return {"open": self.is_open, "failures": self.failures, "retry_at": self.retry_at if self.is_open else None}
+
+api_breaker = CircuitBreaker()
+
+class _NoAnswer:
+    """Type of NO_ANSWER: falsy like "not found", so only callers that care have to tell the two apart."""
+    def __bool__(self): return False
+    def __repr__(self): return "NO_ANSWER"
+
+# Returned by query_screenscraper() when ScreenScraper could not be reached (None means it answered "not found").
+NO_ANSWER = _NoAnswer()
+
 def query_screenscraper(creds, sha1=None, romname=None, systeme=None):
     params = {"devid": creds["devid"], "devpassword": creds["devpassword"], "ssid": creds["ssid"], "sspassword": creds["sspassword"], "softname": "lite_scraper_v2_module", "output": "json"}
     if creds.get("lang") not in [None, "", "none"]: params["langue"] = creds["lang"]
@@ -156,8 +809,33 @@ def query_screenscraper(creds, sha1=None, romname=None, systeme=None):
         if not system_id: return None
         params["romnom"], params["systemeid"] = romname, system_id
     else: return None
+    key = response_key(params)
+    data = response_cache.get(key) if response_cache else None
+    if data is None and cache_peer:
+        data = cache_peer.response(key)
+        if data and response_cache: response_cache.put(key, data)
+    if data:
+        set_media_credentials(data["response"]["jeu"], {k: v for k, v in params.items() if k in CREDENTIAL_PARAMS and k != "output"})
+        return data
+    api_quota.check()
+    api_breaker.before_request()
+    found = reached = False
     try:
-        r = requests.get(SCREENSCRAPER_API, params=params, timeout=15)
+        try:
+            r = requests.get(SCREENSCRAPER_API, params=params, timeout=15)
+            # 401: API closed for non-members (server overloaded), 423: API closed, 429: too many threads
+            if r.status_code >= 500 or r.status_code in (401, 423, 429): r.raise_for_status()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+            log_error(f"ScreenScraper unreachable for {romname or sha1}: {e}")
+            if api_breaker.record_failure():
+                raise ApiUnavailable(f"ScreenScraper is unavailable ({e.__class__.__name__}).", api_breaker.retry_at)
+            return NO_ANSWER
+        api_breaker.record_success()
+        reached = True
+        if r.status_code in (430, 431):
+            # 430: daily request quota, 431: daily quota of unsuccessful lookups
+            api_quota.mark_exhausted()
+            raise QuotaExhausted(f"ScreenScraper refused the request (HTTP {r.status_code}): daily quota reached.")
         r.raise_for_status()
 
         try:
@@ -169,19 +847,124 @@ def query_screenscraper(creds, sha1=None, romname=None, systeme=None):
             return None
 
         if "response" not in data or not isinstance(data["response"].get("jeu"), dict): return None
+        found = True
+        if response_cache: response_cache.put(key, data)
         return data
         
     except requests.exceptions.RequestException as e:
         status_code = e.response.status_code if e.response is not None else "N/A"
         log_error(f"Request failed for {romname or sha1}. Status: {status_code}")
         return None
+    finally:
+        if reached: api_quota.record(found)
+
+HEDGE_BUDGET_UNKNOWN_QUOTA = 100  # extra requests per batch when the daily quota could not be read
+
+class HedgePolicy:
+    """
+    Opt-in hedged lookups: if a lookup has not answered after delay seconds, the next one of the ROM's
+    chain is sent too and the first acceptable answer wins. Each such extra request uses one unit of
+    budget (a share of the quota left at batch start); once it is spent the chain runs sequentially.
+    """
+    def __init__(self, delay, budget):
+        self.delay, self.budget, self.fired, self._lock = delay, budget, 0, threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.fired >= self.budget: return False
+            self.fired += 1
+            return True
+
+hedging = None  # a HedgePolicy while a batch runs with hedged lookups
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+def hedge_policy(flags, quota):
+    """The HedgePolicy for a batch from the settings, or None if hedged lookups are off."""
+    if not _is_true(flags.get("hedged_lookups")): return None
+    remaining = quota.remaining()
+    budget = int(remaining * _float(flags.get("hedge_quota_percent"), 5) / 100) if remaining is not None else HEDGE_BUDGET_UNKNOWN_QUOTA
+    return HedgePolicy(max(0.1, _float(flags.get("hedge_delay_ms"), 1500) / 1000), budget)
+
+def hedged_lookup(creds, lookups, policy):
+    """
+    Runs lookups ([(method, label, query_screenscraper kwargs)], most likely first) with hedging. SHA1
+    hits on 'notgame' entries count as misses, as in the sequential chain. Returns (data, the winning
+    lookup or None, log lines). Lookups not sent yet are dropped once one matches; answers of those
+    still in flight are ignored. QuotaExhausted/ApiUnavailable are raised if nothing matched; data is
+    NO_ANSWER if nothing matched and a lookup got no answer.
+    """
+    pending, notes, error, sent, may_hedge, unanswered = {}, [], None, 0, True, False
+    while True:
+        if not pending and sent < len(lookups) and error is None:
+            pending[_hedge_pool.submit(query_screenscraper, creds, **lookups[sent][2])] = lookups[sent]; sent += 1
+        if not pending: break
+        hedge_now = may_hedge and sent < len(lookups) and error is None
+        done, _ = wait(pending, timeout=policy.delay if hedge_now else None, return_when=FIRST_COMPLETED)
+        if not done:
+            if policy.take():
+                notes.append(f"[HEDGE] No answer after {policy.delay:g} s, also trying {lookups[sent][1]}.")
+                pending[_hedge_pool.submit(query_screenscraper, creds, **lookups[sent][2])] = lookups[sent]; sent += 1
+            else:
+                may_hedge = False
+            continue
+        for future in done:
+            lookup = pending.pop(future)
+            try:
+                data = future.result()
+            except (QuotaExhausted, ApiUnavailable) as e:
+                error = error or e
+                continue
+            unanswered = unanswered or data is NO_ANSWER
+            if data and lookup[0] == "sha1" and data["response"]["jeu"].get("notgame") == 'true':
+                notes.append("[INFO] SHA1 match found a 'notgame' entry. Discarding result and falling back to name search.")
+                data = None
+            if data:
+                for other in pending: other.cancel()
+                return data, lookup, notes
+    if error: raise error
+    return NO_ANSWER if unanswered else None, None, notes
+
+class LatencyStats:
+    """Lookup time per ROM (the last max_samples per mode), to compare "sequential" and "hedged" runs."""
+    def __init__(self, max_samples=5000):
+        self._samples, self._lock, self.max_samples = {}, threading.Lock(), max_samples
+
+    def record(self, mode, seconds):
+        with self._lock:
+            self._samples.setdefault(mode, collections.deque(maxlen=self.max_samples)).append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            samples = {mode: sorted(values) for mode, values in self._samples.items()}
+        return {mode: {"roms": len(v), "p50_s": round(v[len(v) // 2], 2), "p95_s": round(v[min(len(v) - 1, int(len(v) * 0.95))], 2), "max_s": round(v[-1], 2)}
+                for mode, v in samples.items() if v}
+
+    def summary(self):
+        return "; ".join(f"{mode}: p50 {s['p50_s']} s, p95 {s['p95_s']} s over {s['roms']} ROM(s)" for mode, s in self.snapshot().items())
+
+lookup_latency = LatencyStats()
+
+def build_metadata_entry(jeu, rom_path, fallback_name, lang):
+    """gamelist.xml metadata for a ScreenScraper "jeu" object."""
+    scraped_name = jeu.get("noms")[0].get("text") if jeu.get("noms") else jeu.get("nom")
+    return {
+        "rom_path": rom_path, "name": scraped_name or fallback_name,
+        "description": next((s.get("text", "") for s in jeu.get("synopsis", []) if s.get("langue") == lang), ""),
+        "developer": jeu.get("developpeur", {}).get("text", ""), "publisher": jeu.get("editeur", {}).get("text", ""),
+        "players": jeu.get("joueurs", {}).get("text", ""), "genre": next((g["noms"][0].get("text", "") for g in jeu.get("genres", []) if g.get("noms")), ""),
+        "releasedate": f"{next((d.get('text', '') for d in jeu.get('dates', [])), '')}0101T000000"
+    }
 
-def diagnose_rom(rom_name, system_name, creds, temp_dir, flags):
-    downloaded_files = []
+def diagnose_rom(rom_name, system_name, creds, flags):
+    """
+    Looks the game up once and lists the candidate media without downloading anything.
+    Returns {"data": <jeuInfos response>, "candidates": [...]}, each candidate with an "id",
+    its "url", "ext" and the gamelist "media_types" it can be used for.
+    """
     try:
         data = query_screenscraper(creds, romname=rom_name, systeme=system_name)
         if not data:
-            return {"error": f"No entry found for {rom_name}", "files": []}
+            return {"error": f"No entry found for {rom_name}", "candidates": []}
         
         source_for_image = flags.get('source_for_image', 'ss')
         source_for_box = flags.get('source_for_box', 'box-2D')
@@ -189,13 +972,13 @@ def diagnose_rom(rom_name, system_name, creds, temp_dir, flags):
         medias = data["response"]["jeu"].get("medias", [])
         media_list = medias if isinstance(medias, list) else [medias]
         
-        downloaded_urls = set()
+        candidates = {}
 
         for item in media_list:
             source_type = item.get("type")
             url, ext = item.get("url"), item.get("format", "dat")
             
-            if not all([source_type, url, ext]) or url in downloaded_urls:
+            if not all([source_type, url, ext]):
                 continue
 
             target_types_for_this_source = []
@@ -203,7 +986,7 @@ def diagnose_rom(rom_name, system_name, creds, temp_dir, flags):
                 target_types_for_this_source.append("image")
             if source_type == source_for_box:
                 target_types_for_this_source.append("thumbnail")
-            if source_type == "video":
+            if source_type in ["video", LIGHT_VARIANTS["video"]]:
                 target_types_for_this_source.append("video")
             if source_type in ["wheel", "wheel-hd"]:
                 target_types_for_this_source.append("marquee")
@@ -211,34 +994,44 @@ def diagnose_rom(rom_name, system_name, creds, temp_dir, flags):
             if not target_types_for_this_source:
                 continue
 
-            temp_filename = f"{uuid.uuid4()}.{ext}"
-            new_file_path, log_msg = download_media(url, os.path.join(temp_dir, temp_filename))
-            
-            if new_file_path:
-                downloaded_urls.add(url)
-                for target_type in target_types_for_this_source:
-                    downloaded_files.append({"filename": os.path.basename(new_file_path), "media_type": target_type})
+            key = media_url_key(url)
+            if key in candidates:
+                candidates[key]["media_types"] += [t for t in target_types_for_this_source if t not in candidates[key]["media_types"]]
+                continue
+            candidates[key] = {"id": key, "url": url, "ext": ext, "source_type": source_type,
+                               "region": item.get("region"), "media_types": target_types_for_this_source}
 
-        return {"files": downloaded_files}
+        return {"data": data, "candidates": list(candidates.values())}
 
     except Exception as e:
         log_error(f"Diagnose exception: {e}")
-        return {"error": str(e), "files": []}
+        return {"error": str(e), "candidates": []}
 
-def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, flags, google_api_key=None, alt_rom_csv_path=None):
-    rom = Path(rom_path_str)
-    romname = rom.stem
-    gamelist_path = os.path.join(BASE_ROM_PATH, system_name, GAMELIST_XML)
+class RomScrape:
+    """One ROM on its way through SCRAPE_STAGES: the arguments of scrape_rom plus what the stages pass on."""
+    def __init__(self, rom_path_str, xml_path_str, system_name, creds, alt_mappings, flags, google_api_key=None, alt_rom_csv_path=None, fallbacks="all", result=None):
+        self.rom_path_str, self.xml_path_str, self.system_name = rom_path_str, xml_path_str, system_name
+        self.creds, self.alt_mappings, self.flags = creds, alt_mappings, flags
+        self.google_api_key, self.alt_rom_csv_path, self.fallbacks = google_api_key, alt_rom_csv_path, fallbacks
+        self.result = {} if result is None else result
+        self.rom = Path(rom_path_str)
+        self.romname = self.rom.stem
+        self.gamelist_path = os.path.join(BASE_ROM_PATH, system_name, GAMELIST_XML)
+        self.sha1, self.data, self.entry, self.entry_force = None, None, None, False
+        self.lines, self.finished = [], False  # used by scrape_batch
 
+def _hash_stage(job):
+    """Reads the ROM's gamelist entry, settles the skip cases and hashes the ROM for the SHA1 lookup."""
+    rom, romname, gamelist_path, flags, result = job.rom, job.romname, job.gamelist_path, job.flags, job.result
     save_in_rom_dir = flags.get('save_media_in_rom_dir', False)
     media_folder_name = flags.get('name_media_dir', MEDIA_FOLDER)
 
     media_dir = ""
     if save_in_rom_dir:
-        rom_directory = os.path.dirname(rom_path_str)
+        rom_directory = os.path.dirname(job.rom_path_str)
         media_dir = os.path.join(rom_directory, media_folder_name)
     else:
-        media_dir = os.path.join(BASE_ROM_PATH, system_name, media_folder_name)
+        media_dir = os.path.join(BASE_ROM_PATH, job.system_name, media_folder_name)
     
     source_for_image = flags.get('source_for_image', 'ss')
     source_for_box = flags.get('source_for_box', 'box-2D')
@@ -252,35 +1045,29 @@ def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, fla
 
     media_types = list(set(media_source_map.values()))
 
+    # Only this ROM's entry is kept, as {tag: text} of the fields below (see gamelist_io.find_game).
     try:
-        gamelist_tree = ET.parse(gamelist_path) if os.path.exists(gamelist_path) else None
+        game_node = gamelist_io.find_game(gamelist_path, job.xml_path_str, media_types + ["name"]) if os.path.exists(gamelist_path) else None
     except ET.ParseError:
-        yield f"[ERROR] Could not parse gamelist.xml for system {system_name}. It might be corrupt."
-        gamelist_tree = None
-
-    game_node = None
-    if gamelist_tree:
-        for node in gamelist_tree.getroot().findall("game"):
-            if node.get("path") == xml_path_str:
-                game_node = node
-                break
+        yield f"[ERROR] Could not parse gamelist.xml for system {job.system_name}. It might be corrupt."
+        game_node = None
     
     final_media_status = {mtype: False for mtype in media_types}
     has_absolute_path_in_tag = False
     if game_node is not None:
         for media_type in media_types:
-            tag = game_node.find(media_type)
-            if tag is not None and tag.text and tag.text.strip():
-                path_from_tag = tag.text.strip()
+            if game_node.get(media_type, "").strip():
+                path_from_tag = game_node[media_type].strip()
                 full_path_to_check = path_from_tag if path_from_tag.startswith('/') else os.path.join(os.path.dirname(gamelist_path), path_from_tag)
                 if os.path.exists(full_path_to_check):
                     final_media_status[media_type] = True
                 if path_from_tag.startswith('/'):
                     has_absolute_path_in_tag = True
+    job.media_dir, job.media_types, job.game_node, job.final_media_status = media_dir, media_types, game_node, final_media_status
 
     has_all_metadata = False
     if game_node is not None:
-        if game_node.find("name") is not None and game_node.find("name").text:
+        if game_node.get("name"):
             has_all_metadata = True
             
     if has_all_metadata and not flags.get('force') and not flags.get('force_metadata'):
@@ -293,7 +1080,7 @@ def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, fla
                 continue
 
             if final_media_status[media_type]:
-                local_files_found[media_type] = game_node.find(media_type).text
+                local_files_found[media_type] = game_node[media_type]
                 continue
 
             suffix = suffix_map.get(media_type)
@@ -308,23 +1095,57 @@ def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, fla
                 
         if all_local_files_ok:
             yield f"[SKIP] Metadata present. Linking existing local media for '{romname}'."
-            entry_data = {"rom_path": xml_path_str}
+            job.entry = {"rom_path": job.xml_path_str}
             for media_type, path in local_files_found.items():
-                entry_data[f"{media_type}_path"] = path
-            update_gamelist(gamelist_path, entry_data, force=False)
-            return
+                job.entry[f"{media_type}_path"] = path
+            result["status"] = "skipped"
+            return "write"
 
     if not flags.get('force') and all(final_media_status.values()) and not (flags.get('removestockpics') and has_absolute_path_in_tag):
         yield f"[SKIP] All media files are present and no action is required for '{romname}'."
-        if game_node is None or game_node.find("name") is None:
-            update_gamelist(gamelist_path, {"rom_path": xml_path_str, "name": romname})
-        return
+        result["status"] = "skipped"
+        if game_node is None or "name" not in game_node:
+            job.entry = {"rom_path": job.xml_path_str, "name": romname}
+            return "write"
+        return None
 
+    # A clone whose parent set already matched needs no SHA1 lookup (see _lookup_stage).
+    if (job.fallbacks != "only" and rom.is_file() and rom.suffix.lower() not in ['.daphne', '.singe']
+            and not media_share.match_for(job.system_name, romname)):
+        job.sha1 = sha1_hash(rom)
+    return "lookup"
+
+def _lookup_stage(job):
+    """The ScreenScraper lookups: SHA1, name, alternative names and AI guesses, in that order."""
+    rom, romname, system_name, creds, result = job.rom, job.romname, job.system_name, job.creds, job.result
+    alt_mappings, google_api_key, fallbacks = job.alt_mappings, job.google_api_key, job.fallbacks
     yield f"--- [SCRAPE] Processing '{romname}' ---"
-    data = None
+    data, lookups_started = None, time.perf_counter()
+    unanswered = []  # this ROM's lookups that got no answer at all, as opposed to "not found"
+
+    def ask(**params):
+        answer = query_screenscraper(creds, **params)
+        if answer is NO_ANSWER: unanswered.append(params)
+        return answer
+
+    shared_match = media_share.match_for(system_name, romname)
+    if shared_match:
+        yield f"[SHARE] Reusing the match of '{shared_match[0]}' (same parent set)."
+        data, result["method"] = shared_match[1], "parent"
     
-    if rom.is_file() and rom.suffix.lower() not in ['.daphne', '.singe']:
-        data = query_screenscraper(creds, sha1=sha1_hash(rom))
+    if not data and fallbacks != "only" and hedging:
+        lookups = [("name", "ROM Name", {"romname": romname, "systeme": system_name})]
+        if job.sha1:
+            lookups.insert(0, ("sha1", "SHA1 Hash", {"sha1": job.sha1}))
+        data, lookup, notes = hedged_lookup(creds, lookups, hedging)
+        if data is NO_ANSWER: unanswered.append("hedged")
+        yield from notes
+        if data:
+            yield f"[INFO] Found match via {lookup[1]}."
+            result["method"] = lookup[0]
+
+    elif not data and fallbacks != "only" and job.sha1:
+        data = ask(sha1=job.sha1)
         if data:
             jeu = data.get("response", {}).get("jeu", {})
             if jeu.get("notgame") == 'true':
@@ -332,19 +1153,44 @@ def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, fla
                 data = None
             else:
                 yield f"[INFO] Found match via SHA1 Hash."
+                result["method"] = "sha1"
+
+    if not data and fallbacks != "only" and not hedging:
+        data = ask(romname=romname, systeme=system_name)
+        if data:
+            yield f"[INFO] Found match via ROM Name."
+            result["method"] = "name"
+
+    if not data and unanswered:
+        # A lookup never got an answer: retry the ROM instead of reporting it as unmatched.
+        raise ApiUnavailable("ScreenScraper did not answer.", max(api_breaker.retry_at, time.time()))
 
-    if not data:
-        data = query_screenscraper(creds, romname=romname, systeme=system_name)
-        if data: yield f"[INFO] Found match via ROM Name."
+    if not data and fallbacks == "defer":
+        has_alt = any(alt['src_system'] is None or alt['src_system'] == system_name.lower() for alt in alt_mappings.get(romname, []))
+        if has_alt or google_api_key:
+            yield f"[DEFER] No direct match for '{romname}'. Alternative lookups queued until the direct lookups of the batch are done."
+            result["deferred"] = True
+            return None
         
-    if not data and romname in alt_mappings:
+    alts = [alt for alt in alt_mappings.get(romname, []) if alt['src_system'] is None or alt['src_system'] == system_name.lower()] if not data else []
+    if alts and hedging:
+        yield f"[ALT] Trying {len(alts)} alternative name(s) with hedged lookups..."
+        data, lookup, notes = hedged_lookup(creds, [("alt_name", f"Alternative Name ('{alt['alt_name']}')", {"romname": alt['alt_name'], "systeme": alt.get('dest_system') or system_name}) for alt in alts], hedging)
+        if data is NO_ANSWER: unanswered.append("hedged")
+        yield from notes
+        if data:
+            yield f"[INFO] Found match via {lookup[1]}."
+            result["method"] = "alt_name"
+
+    elif not data and romname in alt_mappings:
         for alt in alt_mappings[romname]:
             if alt['src_system'] is None or alt['src_system'] == system_name.lower():
                 alt_romname, alt_system = alt['alt_name'], alt.get('dest_system') or system_name
                 yield f"[ALT] Trying alternative name: '{alt_romname}' on system '{alt_system}'..."
-                data = query_screenscraper(creds, romname=alt_romname, systeme=alt_system)
+                data = ask(romname=alt_romname, systeme=alt_system)
                 if data:
                     yield f"[INFO] Found match via Alternative Name ('{alt_romname}')."
+                    result["method"] = "alt_name"
                     break
 
     if not data and google_api_key:
@@ -355,111 +1201,293 @@ def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, fla
         else:
             for i, title in enumerate(guessed_titles):
                 yield f"[AI] Trying guess #{i+1}: '{title}'..."
-                data = query_screenscraper(creds, romname=title, systeme=system_name)
+                data = ask(romname=title, systeme=system_name)
                 if data:
                     yield f"[INFO] Found match via AI Guess ('{title}')."
-                    if alt_rom_csv_path:
-                        yield append_to_alt_romnames(alt_rom_csv_path, romname, title, system_name)
+                    result["method"] = "ai_guess"
+                    if job.alt_rom_csv_path:
+                        yield append_to_alt_romnames(job.alt_rom_csv_path, romname, title, system_name)
                         if romname not in alt_mappings:
                             alt_mappings[romname] = []
                         alt_mappings[romname].append({'alt_name': title, 'src_system': system_name.lower(), 'dest_system': None})
                         yield "[AI] In-memory mapping updated for current session."
                     break
-    
+
+    if result.get("method") != "parent":
+        lookup_latency.record("hedged" if hedging else "sequential", time.perf_counter() - lookups_started)
     if data:
-        jeu = data["response"]["jeu"]
-        scraped_name = jeu.get("noms")[0].get("text") if jeu.get("noms") else jeu.get("nom")
-        entry = {"rom_path": xml_path_str, "name": scraped_name or romname}
-        entry.update({
-            "description": next((s.get("text", "") for s in jeu.get("synopsis", []) if s.get("langue") == creds.get("lang")), ""),
-            "developer": jeu.get("developpeur", {}).get("text", ""), "publisher": jeu.get("editeur", {}).get("text", ""),
-            "players": jeu.get("joueurs", {}).get("text", ""), "genre": next((g["noms"][0].get("text", "") for g in jeu.get("genres", []) if g.get("noms")), ""),
-            "releasedate": f"{next((d.get('text', '') for d in jeu.get('dates', [])), '')}0101T000000"
-        })
-        
-        source_for_image = flags.get('source_for_image', 'ss')
-        source_for_box = flags.get('source_for_box', 'box-2D')
+        media_share.remember_match(system_name, romname, data)
+        job.data = data
+        return "download"
+    elif unanswered:
+        raise ApiUnavailable("ScreenScraper did not answer.", max(api_breaker.retry_at, time.time()))
+    else:
+        result["status"] = "failed"
+        yield f"[FAIL] No match found for '{romname}' after all attempts."
+        if not google_api_key:
+            yield "[INFO] Tip: Add a free Google AI API key in Advanced Settings to improve results for difficult filenames."
+        return None
+
+def _download_stage(job):
+    """Builds the gamelist entry of the match and fetches (or links) the media it is missing."""
+    romname, gamelist_path, media_dir, flags, result, data = job.romname, job.gamelist_path, job.media_dir, job.flags, job.result, job.data
+    game_node, final_media_status = job.game_node, job.final_media_status
+    jeu = data["response"]["jeu"]
+    entry = build_metadata_entry(jeu, job.xml_path_str, romname, job.creds.get("lang"))
+    result.update({"status": "matched", "game_id": jeu.get("id"), "media": []})
+    
+    source_for_image = flags.get('source_for_image', 'ss')
+    source_for_box = flags.get('source_for_box', 'box-2D')
+    
+    media_options = {mtype: [] for mtype in job.media_types}
+    api_medias = jeu.get("medias", [])
+    
+    for item in api_medias if isinstance(api_medias, list) else [api_medias]:
+        source_type = item.get("type")
+        if source_type == source_for_image and "image" in media_options:
+            media_options["image"].append(item)
+        if source_type == source_for_box and "thumbnail" in media_options:
+            media_options["thumbnail"].append(item)
+        if source_type in ["video", LIGHT_VARIANTS["video"]] and "video" in media_options:
+            media_options["video"].append(item)
+        if source_type in ["wheel", "wheel-hd"] and "marquee" in media_options:
+            media_options["marquee"].append(item)
+
+    downloaded_files_count = 0
+    for target_type, options in media_options.items():
+        if not flags.get(f"scrape_{target_type}", True):
+            continue
+        if not options: continue
         
-        media_options = {mtype: [] for mtype in media_types}
-        api_medias = jeu.get("medias", [])
+        is_present = final_media_status.get(target_type, False)
+        is_absolute = False
+        if game_node and game_node.get(target_type, "").strip().startswith('/'):
+            is_absolute = True
+
+        should_download = flags.get('force') or not is_present or (is_absolute and flags.get('removestockpics'))
         
-        for item in api_medias if isinstance(api_medias, list) else [api_medias]:
-            source_type = item.get("type")
-            if source_type == source_for_image and "image" in media_options:
-                media_options["image"].append(item)
-            if source_type == source_for_box and "thumbnail" in media_options:
-                media_options["thumbnail"].append(item)
-            if source_type == "video" and "video" in media_options:
-                media_options["video"].append(item)
-            if source_type in ["wheel", "wheel-hd"] and "marquee" in media_options:
-                media_options["marquee"].append(item)
-
-        downloaded_files_count = 0
-        for target_type, options in media_options.items():
-            if not flags.get(f"scrape_{target_type}", True):
-                continue
-            if not options: continue
-            
-            is_present = final_media_status.get(target_type, False)
-            is_absolute = False
-            if game_node:
-                tag = game_node.find(target_type)
-                if tag is not None and tag.text and tag.text.strip().startswith('/'):
-                    is_absolute = True
-
-            should_download = flags.get('force') or not is_present or (is_absolute and flags.get('removestockpics'))
+        if should_download:
+            chosen_option = select_media(options, target_type, flags)
+            if not chosen_option: continue
+
+            url, ext = chosen_option.get("url"), chosen_option.get("format", "dat")
             
-            if should_download:
-                strategy = flags.get(f"strategy_for_{target_type}", "best_resolution")
-                chosen_option = None
-
-                if strategy == "first":
-                    chosen_option = options[0]
-                elif strategy == "last":
-                    chosen_option = options[-1]
-                elif strategy == "largest_size":
-                    chosen_option = max(options, key=lambda x: int(x.get('size', 0)))
-                elif strategy == "smallest_size":
-                    chosen_option = min(options, key=lambda x: int(x.get('size', 0)))
-                else: 
-                    chosen_option = max(options, key=lambda x: int(x.get('width', 0)) * int(x.get('height', 0)))
-
-                if not chosen_option: continue
-
-                url, ext = chosen_option.get("url"), chosen_option.get("format", "dat")
-                
-                suffix = "thumb" if target_type == "thumbnail" else target_type
-                filename = f"{romname}-{suffix}.{ext}"
-                destination_path = os.path.join(media_dir, filename)
+            suffix = "thumb" if target_type == "thumbnail" else target_type
+            filename = f"{romname}-{suffix}.{ext}"
+            destination_path = os.path.join(media_dir, filename)
 
-                if os.path.exists(destination_path) and not flags.get('force'):
-                    yield f"[SKIP] Media file already exists: {filename}"
+            if os.path.exists(destination_path):
+                # Compare with ScreenScraper's checksum: identical files are kept even when forced,
+                # corrupt or outdated ones are replaced. Without a checksum only "force" replaces.
+                unchanged = media_digests.matches(destination_path, chosen_option)
+                if unchanged or (unchanged is None and not flags.get('force')):
+                    yield f"[SKIP] Media file unchanged (checksum match): {filename}" if unchanged else f"[SKIP] Media file already exists: {filename}"
                     entry[f"{target_type}_path"] = f"./{os.path.relpath(destination_path, os.path.dirname(gamelist_path)).replace(os.sep, '/')}"
+                    media_share.remember_media(data, target_type, chosen_option, destination_path)
+                    # A processed file must not become the stored original of url.
+                    if unchanged and media_store and not (media_processor and media_processor.source_digests(destination_path)):
+                        media_store.add_file(destination_path, url)
+                    postprocess_media(destination_path)
                     continue
+                if unchanged is False:
+                    yield f"[INFO] Local file differs from ScreenScraper (checksum mismatch), replacing: {filename}"
 
-                new_file_path, log_msg = download_media(url, destination_path)
-                yield log_msg
-                if new_file_path is not None:
-                    entry[f"{target_type}_path"] = f"./{os.path.relpath(new_file_path, os.path.dirname(gamelist_path)).replace(os.sep, '/')}"
-                    downloaded_files_count += 1
-        
-        if downloaded_files_count > 0: yield f"[SUCCESS] Downloaded {downloaded_files_count} new media file(s) for '{romname}'."
-        else: yield f"[SUCCESS] No new media downloaded. Updating gamelist entry for '{romname}'."
-        update_gamelist(gamelist_path, entry, force=(flags.get('force') or flags.get('force_metadata')))
-    else:
-        yield f"[FAIL] No match found for '{romname}' after all attempts."
-        if not google_api_key:
-            yield "[INFO] Tip: Add a free Google AI API key in Advanced Settings to improve results for difficult filenames."
+            # A clone or regional duplicate already got this file in this run: hardlink it, or point to it.
+            shared_path = media_share.media_for(data, target_type, chosen_option)
+            if shared_path and os.path.abspath(shared_path) != os.path.abspath(destination_path):
+                if link_media(shared_path, destination_path):
+                    yield f"[SHARE] Linked {filename} to {os.path.basename(shared_path)}."
+                    shared_path = destination_path
+                    postprocess_media(destination_path)
+                else:
+                    yield f"[SHARE] Using {os.path.basename(shared_path)} for {filename}."
+                entry[f"{target_type}_path"] = f"./{os.path.relpath(shared_path, os.path.dirname(gamelist_path)).replace(os.sep, '/')}"
+                result["media"].append(target_type)
+                continue
+
+            new_file_path, log_msg = media_store.fetch(url, destination_path, chosen_option) if media_store else download_media(url, destination_path)
+            yield log_msg
+            if new_file_path is not None:
+                if media_digests.matches(new_file_path, chosen_option) is False:
+                    yield f"[WARN] Downloaded file does not match the ScreenScraper checksum: {filename}"
+                media_share.remember_media(data, target_type, chosen_option, new_file_path)
+                postprocess_media(new_file_path)
+                result["media"].append(target_type)
+                entry[f"{target_type}_path"] = f"./{os.path.relpath(new_file_path, os.path.dirname(gamelist_path)).replace(os.sep, '/')}"
+                downloaded_files_count += 1
+    
+    if downloaded_files_count > 0: yield f"[SUCCESS] Downloaded {downloaded_files_count} new media file(s) for '{romname}'."
+    else: yield f"[SUCCESS] No new media downloaded. Updating gamelist entry for '{romname}'."
+    job.entry, job.entry_force = entry, (flags.get('force') or flags.get('force_metadata'))
+    return "write"
+
+def _write_stage(job):
+    """Writes the entry to gamelist.xml; scrape_batch runs this stage on a single thread."""
+    yield from ()  # no log lines of its own
+    update_gamelist(job.gamelist_path, job.entry, force=job.entry_force)
+    return None
+
+# Stage generators yield log lines and return the name of the next stage (None when the ROM is done).
+SCRAPE_STAGES = {"hash": _hash_stage, "lookup": _lookup_stage, "download": _download_stage, "write": _write_stage}
+
+def scrape_rom(rom_path_str, xml_path_str, system_name, creds, alt_mappings, flags, google_api_key=None, alt_rom_csv_path=None, fallbacks="all", result=None):
+    """
+    Yields log lines while scraping one ROM. fallbacks="defer" stops after the cheap SHA1/name
+    lookups and sets result["deferred"] if alt-name or AI lookups are still possible;
+    fallbacks="only" then runs just those on a second pass. The outcome is left in result:
+    status ("skipped", "matched", "failed"), method, game_id and the media types fetched.
+    Runs the SCRAPE_STAGES one after the other; scrape_batch runs them as a pipeline.
+    """
+    job = RomScrape(rom_path_str, xml_path_str, system_name, creds, alt_mappings, flags, google_api_key, alt_rom_csv_path, fallbacks, result)
+    stage = "hash"
+    while stage:
+        stage = yield from SCRAPE_STAGES[stage](job)
+
+# Exit codes of the standalone CLI.
+EXIT_OK, EXIT_SETUP_ERROR, EXIT_PARTIAL, EXIT_STOPPED = 0, 1, 2, 3
+# Outcomes after which a ROM counts as done for --resume.
+FINISHED_STATUSES = {"matched", "skipped", "failed"}
+
+# The Pipeline of the running scrape_batch (None when idle), for status pages.
+scrape_pipeline = None
+
+def pipeline_workers(flags, lookup_workers=None):
+    """{stage: threads} from the [pipeline] settings; lookup_workers (e.g. --workers) overrides the setting."""
+    def number(value, default):
+        try: return max(1, int(value))
+        except (TypeError, ValueError): return default
+    lookups = number(lookup_workers or flags.get("lookup_workers"), 1)
+    max_threads = api_quota.snapshot().get("max_threads")
+    if max_threads: lookups = min(lookups, max_threads)  # ScreenScraper's per-account thread limit
+    return {"hash": number(flags.get("hash_workers"), 2), "lookup": lookups,
+            "download": number(flags.get("download_workers"), 4), "write": 1}
+
+def scrape_batch(jobs, creds, alt_mappings, flags, google_api_key=None, alt_rom_csv_path=None, workers=None, stop_event=None, on_api_error=None):
+    """
+    Scrapes (system, rom file, gamelist path) jobs through the SCRAPE_STAGES as a pipeline and yields
+    (job, result, log lines) as each ROM finishes. Every stage has its own threads (pipeline_workers(),
+    workers sets the lookup stage) and a bounded queue, and gamelist.xml has a single writer. flags may
+    be a callable returning the current settings, read as each ROM enters the pipeline. As in the web UI,
+    the SHA1/name lookups of all jobs run before the alternative-name and AI fallbacks.
+    On QuotaExhausted or ApiUnavailable, on_api_error(e) may wait and return True to retry the lookup;
+    otherwise (or once stop_event is set) no further lookup is started: ROMs that are past theirs are
+    still finished, the others get status "interrupted".
+    """
+    global scrape_pipeline
+    stop_event = stop_event or threading.Event()
+    current_flags = flags if callable(flags) else lambda: flags
+    lock, api_lock, api_pause = threading.Lock(), threading.Lock(), {"resumed": 0.0}
+    deferred, direct_left = [], [len(jobs)]
+
+    def leave_direct(job):
+        # Called once per ROM when its SHA1/name lookups are over; the deferred ROMs go on after the last one.
+        if job.fallbacks == "only": return
+        with lock:
+            direct_left[0] -= 1
+            release = deferred[:] if direct_left[0] == 0 else []
+            if release: deferred.clear()
+        if release: scrape_pipeline_ref.feed(release, "lookup")
+
+    def run(name, job):
+        if stop_event.is_set() and name in ("hash", "lookup"):
+            return None  # not finished: reported as interrupted
+        if name == "hash":
+            job.flags = current_flags()
+            if "language" in job.flags: job.creds = {**creds, "lang": job.flags["language"]}
+            if google_api_key is None: job.google_api_key = job.flags.get("api_key") or None
+        while True:
+            failed_at, lines = time.time(), []
+            try:
+                stage = SCRAPE_STAGES[name](job)
+                while True: lines.append(next(stage))
+            except StopIteration as done:
+                nxt = done.value
+            except (QuotaExhausted, ApiUnavailable) as e:
+                with api_lock:
+                    # Another worker may have waited out the same pause already.
+                    retry = api_pause["resumed"] > failed_at or (on_api_error is not None and on_api_error(e))
+                    if retry: api_pause["resumed"] = time.time()
+                if retry and not stop_event.is_set(): continue  # the stage runs again, its lines so far are dropped
+                stop_event.set()
+                job.result.update({"status": "interrupted", "error": str(e)})
+                nxt = None
+            except Exception as e:
+                job.result.update({"status": "error", "error": str(e)})
+                nxt = None
+            break
+        job.lines += lines
+        if name == "lookup" or (name == "hash" and nxt != "lookup"): leave_direct(job)
+        if job.result.pop("deferred", False):
+            job.fallbacks = "only"
+            with lock:
+                if direct_left[0] > 0:
+                    deferred.append(job)
+                    return pipeline.HOLD
+            return "lookup"  # the direct lookups are over already
+        if nxt is None: job.finished = True
+        return nxt
+
+    def failed(job, e):
+        job.result.update({"status": "error", "error": str(e)})
+        job.finished = True
+
+    workers_per_stage = pipeline_workers(current_flags(), workers)
+    scrape_pipeline_ref = scrape_pipeline = pipeline.Pipeline(
+        [(name, functools.partial(run, name), workers_per_stage[name], None) for name in SCRAPE_STAGES], failed)
+    scrape_pipeline_ref.feed(RomScrape(rom_file, xml_path, system_name, creds, alt_mappings, None, google_api_key, alt_rom_csv_path, "defer")
+                             for system_name, rom_file, xml_path in jobs)
+    try:
+        # Deferred ROMs are still held back if the batch was stopped before the direct lookups were done.
+        for job in itertools.chain(scrape_pipeline_ref.results(), deferred):
+            if not job.finished:
+                job.result["status"] = "interrupted"
+            yield (job.system_name, job.rom_path_str, job.xml_path_str), job.result, job.lines
+    finally:
+        scrape_pipeline = None
+
+def _read_checkpoint(checkpoint_path):
+    """{(system, gamelist path)} of the ROMs a previous run finished."""
+    done = set()
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    done.add((entry["system"], entry["rom_path"]))
+                except (ValueError, KeyError):
+                    continue  # torn last line of an interrupted run
+    except FileNotFoundError:
+        pass
+    return done
 
 # --- Standalone Execution Block ---
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Standalone Scraper CLI")
-    parser.add_argument("--system", required=True, help="System folder name to scrape.")
-    parser.add_argument("--rom", help="Path to a specific ROM file to scrape. If not provided, scrapes all ROMs in the system folder.")
+    parser = argparse.ArgumentParser(description="Standalone Scraper CLI",
+        epilog="Exit codes: 0 every ROM was matched or skipped, 1 setup error, 2 some ROMs found no match or failed, "
+               "3 stopped early (quota reached or interrupted; API outages are waited out); continue with --resume.")
+    parser.add_argument("--system", nargs="+", help="System folder name(s) to scrape.")
+    parser.add_argument("--all-systems", action="store_true", help="Scrape every system folder with a known ROM extension list.")
+    parser.add_argument("--rom", help="Path to a specific ROM file to scrape (with a single --system). If not provided, scrapes all ROMs in the system folder(s).")
+    parser.add_argument("--workers", type=int, help="Number of parallel ScreenScraper lookups (default: the lookup_workers setting, "
+                                                    "capped at the account's thread limit). Hashing and downloads have their own settings.")
+    parser.add_argument("--checkpoint", help="Checkpoint file of finished ROMs (default: cli_checkpoint.jsonl in the settings folder).")
+    parser.add_argument("--resume", action="store_true", help="Skip the ROMs the checkpoint lists as finished instead of starting over.")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per line (start, one per ROM, summary) instead of the log.")
     parser.add_argument("--force", action="store_true", help="Force re-downloading all media.")
     parser.add_argument("--force-metadata", action="store_true", help="Force updating metadata.")
     parser.add_argument("--removestockpics", action="store_true", help="Replace media with absolute paths.")
     cli_args = parser.parse_args()
+    if not cli_args.system and not cli_args.all_systems:
+        parser.error("give --system or --all-systems")
+    if cli_args.rom and (cli_args.all_systems or len(cli_args.system) != 1):
+        parser.error("--rom needs exactly one --system")
+
+    def say(message):
+        # In --json mode stdout carries only JSON lines.
+        print(message, file=sys.stderr if cli_args.json else sys.stdout, flush=True)
+
+    def emit(event):
+        print(json.dumps(event, ensure_ascii=False), flush=True)
 
     PROJECT_DIR = os.path.abspath(os.path.dirname(__file__))
     
@@ -468,56 +1496,104 @@ if __name__ == "__main__":
     SETTINGS_CFG_PATH = os.path.join(SETTINGS_DIR, "settings.cfg")
     SS_DEV_CFG_PATH = os.path.join(PROJECT_DIR, "ss_dev.cfg")
     ALT_ROM_CSV = os.path.join(PROJECT_DIR, "alt_rom_names.csv")
+    checkpoint_path = cli_args.checkpoint or os.path.join(SETTINGS_DIR, "cli_checkpoint.jsonl")
 
-    print("--- Starting Scraper in Standalone Mode ---")
+    say("--- Starting Scraper in Standalone Mode ---")
     
-    dev_config = configparser.ConfigParser()
-    dev_config.read(SS_DEV_CFG_PATH, encoding="utf-8")
-    creds = {
-        "devid": decode_if_base64(dev_config.get("credentials", "devid", fallback="")),
-        "devpassword": decode_if_base64(dev_config.get("credentials", "devpassword", fallback=""))
-    }
-
-    user_config = configparser.ConfigParser()
-    user_config.read(SETTINGS_CFG_PATH, encoding="utf-8")
-    creds.update({
-        "ssid": user_config.get("user_credentials", "ssid", fallback=""),
-        "sspassword": user_config.get("user_credentials", "sspassword", fallback="")
-    })
-    google_api_key = user_config.get("google_ai", "api_key", fallback=None)
+    app_settings = settings_store.SettingsStore(SETTINGS_CFG_PATH, SS_DEV_CFG_PATH)
+    creds = app_settings.credentials()
+    google_api_key = app_settings.snapshot()["api_key"] or None
 
     alt_mappings = load_alt_romnames(ALT_ROM_CSV)
     try:
         SYSTEM_ID_MAP = json.loads(Path(PROJECT_DIR, "systems.json").read_text(encoding="utf-8"))
     except Exception as e:
-        print(f"[FATAL_ERROR] Could not load systems.json: {e}")
-        exit(1)
+        say(f"[FATAL_ERROR] Could not load systems.json: {e}")
+        sys.exit(EXIT_SETUP_ERROR)
 
-    flags = {
-        "force": cli_args.force, 
-        "force_metadata": cli_args.force_metadata, 
-        "removestockpics": cli_args.removestockpics
-    }
-    settings_config = configparser.ConfigParser()
-    settings_config.read(SETTINGS_CFG_PATH, encoding="utf-8")
-    for section in ["directories", "media_types", "media_selection", "general", "scraper_flags"]:
-        if settings_config.has_section(section):
-            flags.update(settings_config.items(section))
-            
-    creds['lang'] = flags.get('language', 'none')
+    # Typed settings (booleans are bool, not "False" strings); a force flag given on the command line wins.
+    flags = dict(app_settings.snapshot())
+    for name in ("force", "force_metadata", "removestockpics"):
+        flags[name] = flags[name] or getattr(cli_args, name)
+    creds['lang'] = flags['language']
+    media_digests = MediaDigestCache(os.path.join(SETTINGS_DIR, "media_digests.json"))
+    api_quota = ApiQuota(os.path.join(SETTINGS_DIR, "api_quota.json"))
+    media_share = MediaShare(os.path.join(SETTINGS_DIR, "dats"))
+    media_store = MediaStore(os.path.join(SETTINGS_DIR, "media_store"))
+    response_cache = ResponseCache(os.path.join(SETTINGS_DIR, "response_cache"))
+    peer_url = flags["peer_url"].strip()
+    if peer_url:
+        cache_peer = CachePeer(peer_url if "://" in peer_url else f"http://{peer_url}")
+    api_quota.refresh(creds)
+    hedging = hedge_policy(flags, api_quota)
+    media_processor = media_postprocess.create(os.path.join(SETTINGS_DIR, "processed_media.json"), flags)
+    if flags["optimize_images"] and not media_processor:
+        say("[WARN] Image optimization is on, but Pillow is not installed (pip install Pillow); images are kept as downloaded.")
 
+    scanner = rom_discovery.RomScanner(rom_discovery.load_extensions(os.path.join(PROJECT_DIR, "system_extensions.json")),
+                                       os.path.join(SETTINGS_DIR, "rom_scan_state.json"), skip_dirs=[flags.get("name_media_dir") or MEDIA_FOLDER])
+    systems = cli_args.system or [name for name in sorted(os.listdir(BASE_ROM_PATH))
+                                  if name in scanner.extensions and os.path.isdir(os.path.join(BASE_ROM_PATH, name))]
     if cli_args.rom:
-        system_rom_dir = os.path.join(BASE_ROM_PATH, cli_args.system)
-        rom_files = [Path(cli_args.rom)]
+        rom_file = Path(cli_args.rom).resolve()
+        jobs = [(systems[0], str(rom_file), f"./{rom_file.relative_to(os.path.join(BASE_ROM_PATH, systems[0])).as_posix()}")]
     else:
-        system_rom_dir = os.path.join(BASE_ROM_PATH, cli_args.system)
-        print(f"Scanning for ROMs in: {system_rom_dir}")
-        rom_files = [p for ext in ("*.zip", "*.sfc", "*.smc", ".bin") for p in Path(system_rom_dir).glob(f"**/{ext}")]
-    
-    print(f"Found {len(rom_files)} ROM(s) to process.")
-    for rom_file in rom_files:
-        xml_path_for_rom = f"./{rom_file.relative_to(system_rom_dir).as_posix()}"
-        for message in scrape_rom(str(rom_file), xml_path_for_rom, cli_args.system, creds, alt_mappings, flags, google_api_key, ALT_ROM_CSV):
-            print(message)
-            
-    print("--- Standalone Scrape Complete ---")
\ No newline at end of file
+        jobs = []
+        for system_name in systems:
+            say(f"Scanning for ROMs in: {os.path.join(BASE_ROM_PATH, system_name)}")
+            jobs += [(system_name, os.path.join(BASE_ROM_PATH, system_name, rom_path[2:]), rom_path) for rom_path in scanner.scan(BASE_ROM_PATH, system_name)]
+        scanner.save()
+
+    done = _read_checkpoint(checkpoint_path) if cli_args.resume else set()
+    pending = [job for job in jobs if (job[0], job[2]) not in done]
+    say(f"Found {len(jobs)} ROM(s), {len(jobs) - len(pending)} already finished according to the checkpoint.")
+    if cli_args.json:
+        emit({"event": "start", "systems": systems, "roms": len(jobs), "resumed": len(jobs) - len(pending), "workers": pipeline_workers(flags, cli_args.workers)})
+
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+    counts = {status: 0 for status in ("matched", "skipped", "failed", "error", "interrupted")}
+    stop_event = threading.Event()
+
+    def on_api_error(e):
+        # Outages are waited out (the breaker's backoff) and the ROM is retried; only the daily quota ends the run.
+        if isinstance(e, QuotaExhausted): return False
+        wait = max(0, e.retry_at - time.time())
+        if wait: say(f"[API] {e} Paused, retrying at {time.strftime('%H:%M:%S', time.localtime(e.retry_at))}.")
+        return not stop_event.wait(wait)
+
+    try:
+        with open(checkpoint_path, "a" if cli_args.resume else "w", encoding="utf-8") as checkpoint:
+            for (system_name, rom_file, xml_path), result, lines in scrape_batch(pending, creds, alt_mappings, flags, google_api_key, ALT_ROM_CSV, cli_args.workers, stop_event, on_api_error):
+                status = result.get("status") or "error"
+                counts[status] = counts.get(status, 0) + 1
+                if status in FINISHED_STATUSES:
+                    checkpoint.write(json.dumps({"system": system_name, "rom_path": xml_path, "status": status}) + "\n")
+                    checkpoint.flush()
+                if cli_args.json:
+                    emit({"event": "rom", "system": system_name, "rom_path": xml_path, "status": status, "method": result.get("method"),
+                          "game_id": result.get("game_id"), "media": result.get("media", []), "error": result.get("error"), "log": lines})
+                elif status != "interrupted" or result.get("error"):
+                    say("\n".join(lines + ([f"[{status.upper()}] {result['error']}"] if result.get("error") else [])))
+    except KeyboardInterrupt:
+        stop_event.set()
+        say("Interrupted; finished ROMs are in the checkpoint, continue with --resume.")
+        counts["interrupted"] += len(pending) - sum(counts.values())
+    finally:
+        if media_processor:
+            if media_processor.pending() and not stop_event.is_set(): say(f"Waiting for {media_processor.pending()} image(s) to be optimized...")
+            media_processor.finish(cancel=stop_event.is_set())
+        media_digests.save()
+        media_store.save()
+        api_quota.save()
+
+    if counts["interrupted"]: exit_code = EXIT_STOPPED
+    elif counts["failed"] or counts["error"]: exit_code = EXIT_PARTIAL
+    else: exit_code = EXIT_OK
+    if cli_args.json:
+        emit({"event": "summary", **counts, **({"peer": cache_peer.stats} if cache_peer else {}),
+              "lookup_latency": lookup_latency.snapshot(), **({"hedged_requests": hedging.fired} if hedging else {}),
+              **({"image_optimization": media_processor.stats} if media_processor else {}), "exit_code": exit_code})
+    if lookup_latency.snapshot(): say(f"Lookup time per ROM, {lookup_latency.summary()}.")
+    if media_processor: say(f"Image optimization: {media_processor.summary()}.")
+    say(f"--- Standalone Scrape Complete: {', '.join(f'{k} {v}' for k, v in counts.items())} ---")
+    sys.exit(exit_code)
@@ -1,11 +1,15 @@
 ﻿# -*- coding: utf-8 -*-
 # Version: FINAL-13 (Config & Path Restructure)
-import os, json, re, subprocess, threading, configparser, base64, xml.etree.ElementTree as ET, uuid, csv, shutil, requests
-import scraper_module
-import sys
+import os, json, re, hashlib, subprocess, threading, uuid, csv, shutil, requests, mimetypes
+import scraper_module, catalog, media_gc, ledger, rom_discovery, settings_store, profiling, media_postprocess
+import sys, gzip, time, signal
 from pathlib import Path
 from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse, unquote, urlencode, parse_qs
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # --- PATH DEFINITIONS ---
 PROJECT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -22,56 +26,138 @@ LOG_PATH = os.path.join(PROJECT_DIR, "log.txt")
 TEMP_MEDIA_DIR = os.path.join(PROJECT_DIR, "temp_media")
 BASE_DIR = "/rcade/share/roms"
 ALT_ROM_CSV = os.path.join(PROJECT_DIR, "alt_rom_names.csv")
+COMPRESS_MIN_BYTES = 1024
+CATALOG_SNAPSHOT_PATH = os.path.join(SETTINGS_DIR, "catalog_snapshot.pickle")
+CATALOG_SNAPSHOT_INTERVAL = 300
+MEDIA_CACHE_DIR = os.path.join(SETTINGS_DIR, "media_cache")
+MEDIA_DIGESTS_PATH = os.path.join(SETTINGS_DIR, "media_digests.json")
+API_QUOTA_PATH = os.path.join(SETTINGS_DIR, "api_quota.json")
+MEDIA_STORE_DIR = os.path.join(SETTINGS_DIR, "media_store")
+RESPONSE_CACHE_DIR = os.path.join(SETTINGS_DIR, "response_cache")
+PROCESSED_MEDIA_PATH = os.path.join(SETTINGS_DIR, "processed_media.json")
+LEDGER_PATH = os.path.join(SETTINGS_DIR, "scrape_ledger.sqlite")
+SKIP_FAILED_DAYS = 7  # "skip recent failures" leaves out ROMs that found no match within this many days
+ROM_EXTENSIONS_PATH = os.path.join(PROJECT_DIR, "system_extensions.json")
+ROM_SCAN_STATE_PATH = os.path.join(SETTINGS_DIR, "rom_scan_state.json")
+CLONE_DATS_DIR = os.path.join(SETTINGS_DIR, "dats")  # <system>.xml / <system>.dat (MAME -listxml or Logiqx DAT)
+MAX_DIAGNOSE_SESSIONS = 20
+PROFILING_ENABLED = os.environ.get("SCRAPER_PROFILING") == "1"  # opt-in: /debug/profile samples every thread of the server
 # --- END PATH DEFINITIONS ---
 
-stop_scrape_event, all_systems_data = threading.Event(), {}
+stop_scrape_event, all_systems_data = threading.Event(), catalog.Catalog()
+# Deep-scrape sessions: {session_id: {"rom_name", "system_name", "data", "candidates": {filename: candidate}}}
+diagnose_sessions, diagnose_sessions_lock = {}, threading.Lock()
+media_cache = scraper_module.MediaCache(MEDIA_CACHE_DIR)
+scraper_module.media_digests = scraper_module.MediaDigestCache(MEDIA_DIGESTS_PATH)
+scraper_module.api_quota = scraper_module.ApiQuota(API_QUOTA_PATH)
+scraper_module.media_store = scraper_module.MediaStore(MEDIA_STORE_DIR)
+scraper_module.response_cache = scraper_module.ResponseCache(RESPONSE_CACHE_DIR)
+scrape_state = {"state": "idle", "current": 0, "total": 0, "resume_at": None}
+scrape_ledger = None  # ledger.ScrapeLedger, opened by run_server() once SETTINGS_DIR exists
+rom_scanner = rom_discovery.RomScanner(rom_discovery.load_extensions(ROM_EXTENSIONS_PATH), ROM_SCAN_STATE_PATH)
 scrape_lock = threading.Lock()
-
-def decode_if_base64(s):
-    try:
-        if isinstance(s, str) and (any(c in s for c in ['=','/','+']) or len(s)%4==0):
-            d=base64.b64decode(s.encode()).decode("utf-8")
-            if d.isalnum() or "@" in d or d.lower() in ['true','false'] or d.startswith("sk-or-"): return d
-        return s
-    except Exception: return s
-def read_config(path, section, fields):
-    config = configparser.ConfigParser()
-    config.read(path)
-    data = {}
-    if config.has_section(section):
-        for field in fields:
-            raw_value = config.get(section, field, fallback=fields.get(field))
-            decoded_value = decode_if_base64(raw_value)
-            if isinstance(fields.get(field), bool):
-                data[field] = str(decoded_value).lower() == 'true'
-            else:
-                data[field] = decoded_value
-    return data
-def write_config(path, section, data):
-    config = configparser.ConfigParser(); config.read(path)
-    if not config.has_section(section): config.add_section(section)
-    for key, value in data.items(): config.set(section, str(key), str(value))
-    with open(path, "w") as f: config.write(f)
-
-def read_ss_credentials():
-    dev_creds = read_config(SS_DEV_CFG_PATH, "credentials", {"devid": "", "devpassword": ""})
-    user_creds = read_config(SETTINGS_CFG_PATH, "user_credentials", {"ssid": "", "sspassword": ""})
-    return {**dev_creds, **user_creds}
-
-def read_ui_settings():
-    flags = read_config(SETTINGS_CFG_PATH, "scraper_flags", {"force": False, "force_metadata": False, "removestockpics": False})
-    lang = read_config(SETTINGS_CFG_PATH, "general", {"language": "none"})
-    return {**flags, **lang}
-def read_directory_settings():
-    return read_config(SETTINGS_CFG_PATH, "directories", {"save_media_in_rom_dir": False, "name_media_dir": "downloaded_images"})
-def read_media_type_settings():
-    return read_config(SETTINGS_CFG_PATH, "media_types", {"scrape_image": True, "scrape_video": True, "scrape_marquee": True, "scrape_thumbnail": True, "source_for_image": "ss", "source_for_box": "box-2D"})
-def read_media_selection_settings():
-    return read_config(SETTINGS_CFG_PATH, "media_selection", {"strategy_for_image": "best_resolution", "strategy_for_video": "best_resolution", "strategy_for_marquee": "best_resolution", "strategy_for_thumbnail": "best_resolution"})
-def read_google_ai_credentials():
-    return read_config(SETTINGS_CFG_PATH, "google_ai", {"api_key": ""})
+app_settings = settings_store.SettingsStore(SETTINGS_CFG_PATH, SS_DEV_CFG_PATH)
+request_metrics = profiling.RequestMetrics()
+
+def prioritize_batch(entries, settings):
+    """Orders a scrape batch so the ROMs missing the most enabled media types come first (stable otherwise)."""
+    enabled = [mtype for mtype in catalog.MEDIA_TYPES if scraper_module._is_true(settings.get(f"scrape_{mtype}", True))]
+    data = get_catalog()
+    def missing(entry):
+        game = data.get(entry["actual_system"], entry["rom_path"])
+        if game is None: return len(enabled) + 1
+        return sum(not game[f"{mtype}_exists"] for mtype in enabled) + (not game["has_name"])
+    return sorted(entries, key=missing, reverse=True)
+
+def wait_for_quota_reset(quota, creds, reason):
+    """Blocks the scrape's lookups until the daily quota resets (or the scrape is stopped)."""
+    resume_at = time.time() + quota.seconds_until_reset()
+    scrape_state.update({"state": "paused_quota", "resume_at": resume_at})
+    quota.save()
+    with open(LOG_PATH, "a", encoding="utf-8") as logf:
+        logf.write(f"[QUOTA] {reason} Pausing until {time.strftime('%Y-%m-%d %H:%M', time.localtime(resume_at))}.\n")
+    while not stop_scrape_event.is_set():
+        if stop_scrape_event.wait(min(600, max(1, resume_at - time.time()))): break
+        if time.time() >= resume_at:
+            quota.refresh(creds)
+            if quota.remaining() != 0: break
+            resume_at = time.time() + 3600  # counters not reset yet on the server side
+            scrape_state["resume_at"] = resume_at
+    scrape_state.update({"state": "running", "resume_at": None})
+    if not stop_scrape_event.is_set():
+        with open(LOG_PATH, "a", encoding="utf-8") as logf:
+            logf.write("[QUOTA] Quota reset. Resuming scrape.\n")
+
+def wait_for_api(error):
+    """Blocks the scrape's lookups until the circuit breaker lets the next probe request through."""
+    scrape_state.update({"state": "paused_api", "resume_at": error.retry_at})
+    with open(LOG_PATH, "a", encoding="utf-8") as logf:
+        logf.write(f"[API] {error} Paused, retrying at {time.strftime('%H:%M:%S', time.localtime(error.retry_at))}.\n")
+    stop_scrape_event.wait(max(0, error.retry_at - time.time()))
+    scrape_state.update({"state": "running", "resume_at": None})
+
+def apply_peer_settings(settings):
+    """Points scraper_module at the configured peer cabinet (keeping its stats while the URL is unchanged)."""
+    url = settings["peer_url"].strip().rstrip("/")
+    if url and "://" not in url: url = f"http://{url}"
+    if not url: scraper_module.cache_peer = None
+    elif scraper_module.cache_peer is None or scraper_module.cache_peer.base_url != url:
+        scraper_module.cache_peer = scraper_module.CachePeer(url)
+
+def refresh_catalog():
+    # Rebuilt in place: a replaced Catalog would lose the rows discover_roms() merges into it.
+    all_systems_data.rebuild(BASE_DIR)
+    return all_systems_data
+def get_catalog(systems=None):
+    """The in-memory catalog, with the given systems (all if None) revalidated against their gamelist.xml mtime."""
+    if not all_systems_data:
+        return refresh_catalog()
+    all_systems_data.revalidate(BASE_DIR, systems)
+    return all_systems_data
+def discover_roms(systems=None):
+    """Merges ROM files that no gamelist.xml lists yet into the catalog as scrape candidates. Returns {system: rows added}."""
+    data = get_catalog()
+    rom_scanner.skip_dirs.add((app_settings.snapshot()["name_media_dir"] or scraper_module.MEDIA_FOLDER).lower())
+    if systems is None:
+        systems = [name for name in sorted(os.listdir(BASE_DIR)) if name in rom_scanner.extensions and os.path.isdir(os.path.join(BASE_DIR, name))]
+    added = {system: data.merge_untracked(system, rom_scanner.scan(BASE_DIR, system)) for system in systems}
+    rom_scanner.save()
+    return {system: count for system, count in added.items() if count}
+
+def save_catalog_snapshot():
+    if not all_systems_data or all_systems_data.generation == all_systems_data.saved_generation: return
+    try: catalog.save_snapshot(all_systems_data, CATALOG_SNAPSHOT_PATH)
+    except Exception as e: print(f"??  Could not save catalog snapshot: {e}")
+def catalog_snapshot_loop():
+    while True:
+        time.sleep(CATALOG_SNAPSHOT_INTERVAL)
+        save_catalog_snapshot()
+def cleanup_temp_sessions():
+    for item_name in os.listdir(TEMP_MEDIA_DIR):
+        item_path = os.path.join(TEMP_MEDIA_DIR, item_name)
+        if os.path.isdir(item_path):
+            try: shutil.rmtree(item_path)
+            except Exception as e: print(f"  ?? Could not remove {item_path}: {e}")
 
 class CustomHandler(SimpleHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        self.wfile = profiling.CountingWriter(self.wfile)
+    def handle_one_request(self):
+        # Times every request (API and static files) and records it under the endpoint do_GET/do_POST chose.
+        started, self._status, self._endpoint, self.wfile.count = time.perf_counter(), None, None, 0
+        try:
+            super().handle_one_request()
+        finally:
+            if self._status is not None:
+                request_metrics.record(self.command or "-", self._endpoint or "invalid", self._status, (time.perf_counter() - started) * 1000, self.wfile.count)
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+    def _static_endpoint(self, path):
+        """Metrics name of a static path: "/roms/*", "/lang/*", ... or the web file itself."""
+        parts = path.split("/", 2)
+        return f"/{parts[1]}/*" if len(parts) > 2 else path
     def handle_list_backups(self):
         os.makedirs(BACKUP_DIR, exist_ok=True)
         try:
@@ -179,8 +265,11 @@ class CustomHandler(SimpleHTTPRequestHandler):
             "/restore-backup": self.handle_restore_backup,
             "/test-api-key": self.handle_test_api_key,
             "/reset-settings-to-default": self.handle_reset_settings, # <-- NEW ENDPOINT
+            "/media-gc": self.handle_media_gc,
+            "/discover-roms": self.handle_discover_roms,
         }
         handler = endpoints.get(path)
+        self._endpoint = path if handler else "unknown"
         if handler: handler()
         else: self.send_error(404, "Unknown POST path")
     def do_GET(self):
@@ -191,16 +280,49 @@ class CustomHandler(SimpleHTTPRequestHandler):
             "/get-system-id-map": self.handle_get_system_id_map,
             "/get-rom-details": self.handle_get_rom_details,
             "/get-system-data": self.handle_get_system_data,
+            "/get-system-summary": self.handle_get_system_summary,
+            "/get-system-page": self.handle_get_system_page,
+            "/query-roms": self.handle_query_roms,
+            "/scrape-status": self.handle_scrape_status,
+            "/media-gc": self.handle_media_gc,
+            "/ledger-summary": self.handle_ledger_summary,
+            "/ledger-roms": self.handle_ledger_roms,
+            "/diagnose-preview": self.handle_diagnose_preview,
+            "/debug/catalog-memory": self.handle_debug_catalog_memory,
+            "/debug/request-metrics": self.handle_debug_request_metrics,
+            "/debug/profile": self.handle_debug_profile,
             "/list-backups": self.handle_list_backups,
             "/get-backup-details": self.handle_get_backup_details,
             "/check-update": self.handle_check_update,	
+            "/peer/response": self.handle_peer_response,
+            "/peer/media": self.handle_peer_media,
         }
         handler = endpoints.get(path)
+        self._endpoint = path if handler else self._static_endpoint(path)
         if handler: handler()
         else: super().do_GET()
     def _send_json(self, data, status=200):
-        self.send_response(status); self.send_header("Content-Type", "application/json; charset=utf-8"); self.end_headers()
-        self.wfile.write(json.dumps(data).encode("utf-8"))
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        encoding = self._negotiate_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+        if encoding == "br": body = brotli.compress(body, quality=5)
+        elif encoding == "gzip": body = gzip.compress(body, compresslevel=6)
+        self.send_response(status); self.send_header("Content-Type", "application/json; charset=utf-8")
+        if encoding: self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+    def _negotiate_encoding(self):
+        accepted = {}
+        for part in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = part.strip().partition(";")
+            q = params.strip()[2:] if params.strip().startswith("q=") else "1"
+            try: accepted[name.strip().lower()] = float(q)
+            except ValueError: continue
+        if brotli is not None and accepted.get("br", 0) > 0: return "br"
+        if accepted.get("gzip", 0) > 0: return "gzip"
+        return None
+    def _query_int(self, query, name, default):
+        try: return max(0, int(query.get(name, [default])[0]))
+        except (TypeError, ValueError): return default
     def _get_post_payload(self):
         cl = int(self.headers.get('Content-Length', 0)); return json.loads(self.rfile.read(cl)) if cl > 0 else {}
     def handle_get_log(self):
@@ -210,135 +332,197 @@ class CustomHandler(SimpleHTTPRequestHandler):
             self.wfile.write(content.encode("utf-8"))
         except Exception as e: self.send_error(500, f"Failed to read log: {e}")
     def handle_get_settings(self):
-        settings = {
-            **read_ss_credentials(), 
-            **read_ui_settings(), 
-            **read_media_type_settings(),
-            **read_directory_settings(),
-            **read_media_selection_settings(),
-            **read_google_ai_credentials()
-        }
-        self._send_json(settings)
+        self._send_json({**app_settings.credentials(), **app_settings.snapshot()})
     def handle_get_system_id_map(self):
         try: self._send_json(json.loads(Path(PROJECT_DIR, "systems.json").read_text(encoding="utf-8")))
         except Exception as e: self.send_error(500, f"Error reading systems.json: {e}")
     def handle_get_rom_details(self):
         query = parse_qs(urlparse(self.path).query)
         rom_path, system_name = query.get("romPath", [""])[0], query.get("system", [""])[0]
-        selected_rom = next((rom for rom in all_systems_data.get(system_name, []) if rom.get("rom_path") == rom_path), None)
+        selected_rom = get_catalog([system_name]).get(system_name, rom_path)
         if selected_rom: self._send_json(selected_rom)
         else: self.send_error(404, "ROM not found in cache")
     def handle_get_system_data(self):
-        global all_systems_data
-        all_systems_data = {"ALL": []}
-        
-        for system_name in sorted(os.listdir(BASE_DIR)):
-            system_path = os.path.join(BASE_DIR, system_name)
-            gamelist_path = os.path.join(system_path, "gamelist.xml")
-            
-            if not (os.path.isdir(system_path) and os.path.exists(gamelist_path)):
-                continue
-                
-            system_games = []
-
-            try:
-                gamelist_root = ET.parse(gamelist_path).getroot()
-                gamelist_dir = os.path.dirname(gamelist_path)
-
-                for game_el in gamelist_root.findall("game"):
-                    path_raw = game_el.get("path")
-                    if not path_raw or game_el.get("deleted") == "yes":
-                        continue
-                    
-                    name_el = game_el.find("name")
-                    game_name = name_el.text if name_el is not None else Path(path_raw).stem
-
-                    def get_media_info(tag_name):
-                        tag = game_el.find(tag_name)
-                        path = tag.text.strip() if tag is not None and tag.text and tag.text.strip() else None
-                        if not path:
-                            return None, False
-                        
-                        full_path = path if path.startswith('/') else os.path.join(gamelist_dir, path)
-                        return path, os.path.exists(full_path)
-
-                    image_path, image_exists = get_media_info("image")
-                    video_path, video_exists = get_media_info("video")
-                    marquee_path, marquee_exists = get_media_info("marquee")
-                    thumbnail_path, thumbnail_exists = get_media_info("thumbnail")
-
-                    game_entry = {
-                        "rom_path": path_raw,
-                        "game_name": game_name,
-                        "actual_system": system_name,
-                        "image_path": image_path, "image_exists": image_exists,
-                        "video_path": video_path, "video_exists": video_exists,
-                        "marquee_path": marquee_path, "marquee_exists": marquee_exists,
-                        "thumbnail_path": thumbnail_path, "thumbnail_exists": thumbnail_exists,
-                    }
-                    
-                    system_games.append(game_entry)
-                    all_systems_data["ALL"].append(game_entry)
-                    
-            except Exception as e:
-                print(f"Error processing gamelist for {system_name}: {e}")
-                
-            if system_games:
-                all_systems_data[system_name] = system_games
-                
-        self._send_json(all_systems_data)
+        # Always rescans. ?format=columns returns the compact layout, otherwise the legacy per-game dicts.
+        refresh_catalog()
+        query = parse_qs(urlparse(self.path).query)
+        if query.get("format", [""])[0] == "columns":
+            self._send_json(all_systems_data.encode_columns())
+        else:
+            self._send_json(all_systems_data.with_all_list())
+    def handle_get_system_summary(self):
+        query = parse_qs(urlparse(self.path).query)
+        if query.get("refresh", ["0"])[0] == "1":
+            refresh_catalog()
+            discover_roms()
+        self._send_json(get_catalog().summary())
+    def handle_get_system_page(self):
+        query = parse_qs(urlparse(self.path).query)
+        system_name = query.get("system", ["ALL"])[0]
+        data = get_catalog(None if system_name == "ALL" else [system_name])
+        if system_name != "ALL" and system_name not in data.tables:
+            return self._send_json({"error": f"Unknown system: {system_name}"}, status=404)
+        offset, limit = self._query_int(query, "offset", 0), self._query_int(query, "limit", 500)
+        systems = None if system_name == "ALL" else [system_name]
+        self._send_json({"limit": limit, **data.encode_columns(systems, offset, limit or None)})
+    def handle_query_roms(self):
+        """
+        Filtered, sorted and paginated view of the catalog in the column format.
+        ?system=&missing=image,video&q=&prefix=&status=unscraped|partial|complete&sort=name|rom|system|missing&order=asc|desc&offset=&limit=
+        Scrape status only considers the media types enabled in the settings unless ?media= lists them.
+        """
+        query = parse_qs(urlparse(self.path).query)
+        arg = lambda name: query.get(name, [""])[0].strip()
+        status = arg("status") or None
+        if status and status not in catalog.SCRAPE_STATUSES:
+            return self._send_json({"error": f"Unknown status: {status}"}, status=400)
+        if arg("media"):
+            media_types = tuple(m for m in arg("media").split(",") if m in catalog.MEDIA_TYPES)
+        else:
+            enabled = app_settings.snapshot()
+            media_types = tuple(m for m in catalog.MEDIA_TYPES if enabled.get(f"scrape_{m}", True))
+        data = get_catalog([arg("system")] if arg("system") and arg("system") != "ALL" else None)
+        matches = data.query(
+            system=arg("system") or None, missing=[m for m in arg("missing").split(",") if m],
+            text=arg("q"), prefix=arg("prefix"), status=status,
+            sort=arg("sort") or None, descending=arg("order") == "desc", media_types=media_types or catalog.MEDIA_TYPES)
+        offset, limit = self._query_int(query, "offset", 0), self._query_int(query, "limit", 200)
+        self._send_json({"limit": limit, **data.encode_rows(matches, offset, limit or None)})
+    def handle_debug_catalog_memory(self):
+        """Deep size of the in-memory catalog. ?compare=1 also measures the same games as per-game dicts."""
+        query = parse_qs(urlparse(self.path).query)
+        data = get_catalog()
+        report = data.memory_report()
+        if query.get("compare", ["0"])[0] == "1":
+            legacy_bytes = catalog.legacy_memory_estimate(data)
+            report["legacy_dict_bytes"] = legacy_bytes
+            report["saved_percent"] = round(100 * (1 - report["bytes"] / legacy_bytes), 1) if legacy_bytes else 0
+        self._send_json(report)
+    def handle_debug_request_metrics(self):
+        """Latency/size histograms per endpoint since start or the last ?reset=1."""
+        report = request_metrics.snapshot()
+        if parse_qs(urlparse(self.path).query).get("reset", ["0"])[0] == "1": request_metrics.reset()
+        self._send_json(report)
+    def handle_debug_profile(self):
+        """?seconds=N (default 10): sampling profile of all threads as a folded-stacks download. Needs SCRAPER_PROFILING=1."""
+        if not PROFILING_ENABLED:
+            return self._send_json({"error": "Profiling is disabled. Start the server with SCRAPER_PROFILING=1."}, status=403)
+        seconds = self._query_int(parse_qs(urlparse(self.path).query), "seconds", 10) or 10
+        try:
+            body = profiling.sample_profile(seconds).encode("utf-8")
+        except RuntimeError as e:
+            return self._send_json({"error": str(e)}, status=409)
+        self.send_response(200); self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Disposition", f'attachment; filename="scraper-profile-{time.strftime("%Y%m%d-%H%M%S")}.folded"')
+        self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def handle_media_gc(self):
+        """GET: dry-run report. POST {"prune_entries", "include_store"}: deletes what the report lists."""
+        dry_run = self.command == "GET"
+        payload = {} if dry_run else self._get_post_payload()
+        # Never delete while a scrape may be writing media or gamelists.
+        if not scrape_lock.acquire(blocking=False):
+            self._send_json({"error": "A scrape is in progress."}, status=409)
+            return
+        try:
+            report = media_gc.collect_garbage(BASE_DIR, app_settings.snapshot()["name_media_dir"] or scraper_module.MEDIA_FOLDER,
+                                              dry_run=dry_run, prune_entries=bool(payload.get("prune_entries")),
+                                              store_dir=MEDIA_STORE_DIR, include_store=bool(payload.get("include_store")),
+                                              processed_record_path=PROCESSED_MEDIA_PATH)
+        finally:
+            scrape_lock.release()
+        if not dry_run:
+            with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                logf.write(f"[GC] {'Deleted' if report['orphans_deleted'] else 'Kept (a gamelist.xml could not be parsed)'} {report['orphan_count']} orphaned media file(s) ({report['orphan_bytes'] / 2**20:.1f} MB)"
+                           f"{', pruned ' + str(report['stale_count']) + ' stale entries' if payload.get('prune_entries') else ''}.\n")
+        self._send_json(report)
+
+    def handle_discover_roms(self):
+        systems = self._get_post_payload().get("systems") or None
+        started = time.perf_counter()
+        added = discover_roms(systems)
+        self._send_json({"added": added, "untracked": {s: len(p) for s, p in all_systems_data.untracked.items()},
+                         "elapsed_ms": round((time.perf_counter() - started) * 1000)})
+
+    def handle_ledger_summary(self):
+        self._send_json({"systems": scrape_ledger.summary()})
+
+    def handle_ledger_roms(self):
+        query = parse_qs(urlparse(self.path).query)
+        system = query.get("system", [""])[0]
+        statuses = tuple(query.get("status", ["failed,error"])[0].split(","))
+        self._send_json({"system": system, "rom_paths": scrape_ledger.rom_paths(system, statuses)})
 
     def handle_scrape(self):
         if not scrape_lock.acquire(blocking=False):
             self.send_error(409, "A scrape is already in progress.")
             return
     
-        # Reset the stop event flag and clear the log file for the new scrape
-        stop_scrape_event.clear()
-        with open(LOG_PATH, "w", encoding="utf-8") as logf:
-            logf.write("=== Scrape started ===\n\n")
-            logf.flush()
+        try:
+            # Reset the stop event flag and clear the log file for the new scrape
+            stop_scrape_event.clear()
+            with open(LOG_PATH, "w", encoding="utf-8") as logf:
+                logf.write("=== Scrape started ===\n\n")
+                logf.flush()
     
-        payload = self._get_post_payload()
-        roms_to_scrape = payload.get("roms_to_scrape_data", [])
+            payload = self._get_post_payload()
+            roms_to_scrape = payload.get("roms_to_scrape_data", [])
+            mode = payload.get("mode", "selected")
+            if mode == "failed_only":
+                roms_to_scrape = [{"rom_path": rom_path, "actual_system": system} for system in payload.get("systems", []) for rom_path in scrape_ledger.rom_paths(system)]
+            elif mode == "skip_recent_failures":
+                recent = {system: scrape_ledger.recent_failures(system, SKIP_FAILED_DAYS) for system in {e.get("actual_system") for e in roms_to_scrape}}
+                kept = [e for e in roms_to_scrape if e.get("rom_path") not in recent[e.get("actual_system")]]
+                with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                    logf.write(f"[LEDGER] Skipping {len(roms_to_scrape) - len(kept)} ROM(s) that found no match in the last {SKIP_FAILED_DAYS} days.\n")
+                roms_to_scrape = kept
     
-        # Start the scrape in a new thread
-        threading.Thread(target=self.run_scrape_thread, args=(roms_to_scrape,)).start()
+            # Start the scrape in a new thread
+            threading.Thread(target=self.run_scrape_thread, args=(roms_to_scrape,)).start()
+        except Exception as e:
+            # The scrape thread that releases the lock never started (e.g. the ledger database is locked or corrupt).
+            scrape_lock.release()
+            self._send_json({"error": f"Could not start the scrape: {e}"}, status=500)
+            return
     
         self._send_json({"status": "started"})
 		
     def handle_diagnose_scrape(self):
+        # Only looks the game up. Previews are fetched on demand through /diagnose-preview.
         payload = self._get_post_payload()
         rom_name, system_name = payload.get("romName"), payload.get("systemName")
         if not rom_name or not system_name: 
             return self.send_error(400, "ROM Name or System Name missing.")
         
         session_id = str(uuid.uuid4())
-        session_temp_dir = os.path.join(TEMP_MEDIA_DIR, session_id)
-        os.makedirs(session_temp_dir, exist_ok=True)
     
         with open(LOG_PATH, "a", encoding="utf-8") as logf: 
             logf.write(f"\n--- Starting Diagnose Scrape for '{rom_name}' ---\n")
         
         try:
-            creds = read_ss_credentials()
+            creds = app_settings.credentials()
             scraper_module.SYSTEM_ID_MAP = json.loads(Path(PROJECT_DIR, "systems.json").read_text(encoding="utf-8"))
 
-            flags = {
-                **read_ui_settings(), 
-                **read_directory_settings(), 
-                **read_media_type_settings(),
-                **read_media_selection_settings()
-            }
-            scraped_data = scraper_module.diagnose_rom(rom_name, system_name, creds, session_temp_dir, flags)
-        
+            flags = app_settings.snapshot()
+            creds["lang"] = flags["language"]
+            apply_peer_settings(flags)
+            scraped_data = scraper_module.diagnose_rom(rom_name, system_name, creds, flags)
+            candidates = {f"{c['id']}.{c['ext']}": c for c in scraped_data.get("candidates", [])}
+
+            with diagnose_sessions_lock:
+                diagnose_sessions[session_id] = {"rom_name": rom_name, "system_name": system_name, "lang": creds["lang"],
+                                                 "data": scraped_data.get("data"), "candidates": candidates}
+                while len(diagnose_sessions) > MAX_DIAGNOSE_SESSIONS:
+                    diagnose_sessions.pop(next(iter(diagnose_sessions)))
+
             files = [
                 {
-                    "url": f"/temp_media/{session_id}/{f['filename']}",
-                    "original_filename": f['filename'],
-                    "media_type": f['media_type']
+                    "url": f"/diagnose-preview?{urlencode({'session_id': session_id, 'file': filename})}",
+                    "original_filename": filename,
+                    "media_type": media_type
                 } 
-                for f in scraped_data.get("files", [])
+                for filename, candidate in candidates.items() for media_type in candidate["media_types"]
             ]
         
             self._send_json({"session_id": session_id, "files": files})
@@ -347,6 +531,52 @@ class CustomHandler(SimpleHTTPRequestHandler):
             err_msg = f"Diagnose scrape failed: {e}"
             with open(LOG_PATH, "a", encoding="utf-8") as logf: logf.write(f"[ERROR] {err_msg}\n")
             self.send_error(500, err_msg)
+    def _get_session_candidate(self, session_id, filename):
+        with diagnose_sessions_lock:
+            session = diagnose_sessions.get(session_id)
+        return session["candidates"].get(filename) if session else None
+    def handle_diagnose_preview(self):
+        query = parse_qs(urlparse(self.path).query)
+        candidate = self._get_session_candidate(query.get("session_id", [""])[0], query.get("file", [""])[0])
+        if not candidate:
+            return self.send_error(404, "Unknown preview.")
+        cached_path, log_msg = media_cache.get(candidate["url"], candidate["ext"])
+        if not cached_path:
+            return self.send_error(502, log_msg)
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(cached_path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(cached_path)))
+        self.send_header("Cache-Control", "private, max-age=3600")
+        self.end_headers()
+        with open(cached_path, "rb") as f: shutil.copyfileobj(f, self.wfile)
+    def _peer_key(self):
+        """The ?key= of a peer request, or None after answering 403/400 (sharing off, malformed key)."""
+        if not app_settings.snapshot()["share_peer_cache"]:
+            self._send_json({"error": "Cache sharing is disabled on this cabinet."}, status=403)
+            return None
+        key = parse_qs(urlparse(self.path).query).get("key", [""])[0]
+        if not re.fullmatch(r"[0-9a-f]{40}", key):
+            self._send_json({"error": "Invalid key."}, status=400)
+            return None
+        return key
+    def handle_peer_response(self):
+        """A cached jeuInfos answer for another cabinet (see scraper_module.CachePeer)."""
+        key = self._peer_key()
+        if key is None: return
+        body = scraper_module.response_cache.raw(key)
+        if body is None: return self.send_error(404, "Not cached.")
+        self.send_response(200); self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("X-Content-SHA1", hashlib.sha1(body).hexdigest()); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+    def handle_peer_media(self):
+        """A media store file by media URL key; its blob name is its SHA1."""
+        key = self._peer_key()
+        if key is None: return
+        blob = scraper_module.media_store.blob_for_key(key)
+        if blob is None: return self.send_error(404, "Not stored.")
+        self.send_response(200); self.send_header("Content-Type", mimetypes.guess_type(blob)[0] or "application/octet-stream")
+        self.send_header("X-Content-SHA1", os.path.basename(blob).split(".")[0]); self.send_header("Content-Length", str(os.path.getsize(blob))); self.end_headers()
+        with open(blob, "rb") as f: shutil.copyfileobj(f, self.wfile)
 			
     def handle_confirm_scrape(self):
         payload = self._get_post_payload()
@@ -359,6 +589,7 @@ class CustomHandler(SimpleHTTPRequestHandler):
                 logf.write(f"\n--- Confirming Scrape for {payload['original_rom_path']} ---\n")
             
             saved_media_paths = self.move_media_files(payload, temp_dir)
+            scraper_module.media_store.save()
             
             self.update_alt_rom_names(payload)
             
@@ -370,11 +601,13 @@ class CustomHandler(SimpleHTTPRequestHandler):
             with open(LOG_PATH, "a", encoding="utf-8") as logf: logf.write(f"[ERROR] Confirmation failed: {e}\n")
             self.send_error(500, f"Confirmation failed: {e}")
         finally:
+            with diagnose_sessions_lock: diagnose_sessions.pop(payload["session_id"], None)
             if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
     def handle_cleanup_session(self):
         payload = self._get_post_payload()
         session_id = payload.get("session_id")
         if not session_id or not re.match(r'^[a-f0-9\-]+$', session_id): return self.send_error(400, "Invalid or missing Session ID.")
+        with diagnose_sessions_lock: diagnose_sessions.pop(session_id, None)
         session_dir = os.path.join(TEMP_MEDIA_DIR, session_id)
         if os.path.isdir(session_dir):
             try:
@@ -384,44 +617,18 @@ class CustomHandler(SimpleHTTPRequestHandler):
                 with open(LOG_PATH, "a", encoding="utf-8") as logf: logf.write(f"Failed to cleanup session {session_id}: {e}\n")
         self._send_json({"status": "cleaned"})
     def handle_stop_scrape(self): stop_scrape_event.set(); self._send_json({"status": "stopping"})
+    def handle_scrape_status(self):
+        self._send_json({**scrape_state, "quota": scraper_module.api_quota.snapshot(), "api": scraper_module.api_breaker.snapshot(),
+                         "lookup_latency": scraper_module.lookup_latency.snapshot(),
+                         "pipeline": scraper_module.scrape_pipeline.snapshot() if scraper_module.scrape_pipeline else None})
     def handle_save_settings(self):
         payload = self._get_post_payload()
-
-        if "ssid" in payload: 
-            write_config(SETTINGS_CFG_PATH, "user_credentials", {"ssid": payload["ssid"], "sspassword": payload["sspassword"]})
-			
-        if "api_key" in payload: 
-            write_config(SETTINGS_CFG_PATH, "google_ai", {"api_key": payload["api_key"]})
-			
-        media_keys = [k for k in payload if k.startswith('scrape_') or k.startswith('source_for_')]
-        if media_keys:
-            media_settings = {key: payload[key] for key in media_keys}
-            write_config(SETTINGS_CFG_PATH, "media_types", media_settings)
-
-        dir_keys = [k for k in payload if k in ['save_media_in_rom_dir', 'name_media_dir']]
-        if dir_keys:
-            dir_settings = {key: payload[key] for key in dir_keys}
-            write_config(SETTINGS_CFG_PATH, "directories", dir_settings)
-
-        selection_keys = [k for k in payload if k.startswith('strategy_for_')]
-        if selection_keys:
-            selection_settings = {key: payload[key] for key in selection_keys}
-            write_config(SETTINGS_CFG_PATH, "media_selection", selection_settings)
-
-        general_keys = [k for k in payload if k in ['language', 'force', 'force_metadata', 'removestockpics']]
-        if general_keys:
-            general_settings_to_write = {}
-            if 'language' in payload:
-                write_config(SETTINGS_CFG_PATH, "general", {"language": payload.get("language", "none")})
-            
-            flag_settings = {k: payload[k] for k in ['force', 'force_metadata', 'removestockpics'] if k in payload}
-            if flag_settings:
-                 write_config(SETTINGS_CFG_PATH, "scraper_flags", flag_settings)
+        app_settings.update(payload)  # one write for all sections; a running scrape picks it up with its next ROM
 
         user_friendly_msg = ""
         if payload.get("perform_login_check") and "ssid" in payload:
-            creds = read_config(SS_DEV_CFG_PATH, "credentials", {"devid":"", "devpassword":""}) # Read dev creds
-            params = urlencode({"devid": decode_if_base64(creds["devid"]), "devpassword": decode_if_base64(creds["devpassword"]), "ssid": payload["ssid"], "sspassword": payload["sspassword"], "output": "json"})
+            creds = app_settings.credentials()
+            params = urlencode({"devid": creds["devid"], "devpassword": creds["devpassword"], "ssid": payload["ssid"], "sspassword": payload["sspassword"], "output": "json"})
             try:
                 resp = requests.get(f"https://www.screenscraper.fr/api2/ssuserInfos.php?{params}", timeout=10)
                 if resp.status_code == 200 and resp.json().get("header", {}).get("success") == "true": login_msg = "Login OK"
@@ -436,7 +643,7 @@ class CustomHandler(SimpleHTTPRequestHandler):
     def handle_reset_settings(self):
         """ Overwrites the current settings.cfg with the default one. """
         try:
-            shutil.copy2(DEFAULT_SETTINGS_CFG_PATH, SETTINGS_CFG_PATH)
+            shutil.copyfile(DEFAULT_SETTINGS_CFG_PATH, SETTINGS_CFG_PATH)  # fresh mtime, so app_settings re-reads it
             self._send_json({"status": "success", "message": "Settings have been reset to default."})
         except Exception as e:
             self._send_json({"error": f"Failed to reset settings: {e}"}, status=500)
@@ -460,9 +667,9 @@ class CustomHandler(SimpleHTTPRequestHandler):
     def move_media_files(self, payload, temp_dir):
         from collections import defaultdict
         
-        dir_settings = read_directory_settings()
-        save_in_rom_dir = dir_settings.get('save_media_in_rom_dir', False)
-        media_folder_name = dir_settings.get('name_media_dir', 'downloaded_images')
+        dir_settings = app_settings.snapshot()
+        save_in_rom_dir = dir_settings['save_media_in_rom_dir']
+        media_folder_name = dir_settings['name_media_dir'] or 'downloaded_images'
         gamelist_path = os.path.join(BASE_DIR, payload['original_system'], "gamelist.xml")
 
         final_media_dir = ""
@@ -483,7 +690,12 @@ class CustomHandler(SimpleHTTPRequestHandler):
         suffix_map = {"image": "image", "video": "video", "marquee": "marquee", "thumbnail": "thumb"}
 
         for filename, media_types in source_to_targets.items():
-            if not filename or not media_types or not os.path.exists(os.path.join(temp_dir, filename)):
+            if not filename or not media_types:
+                continue
+            # Previews live in the shared media cache (fetched now if never viewed), older sessions in temp_dir.
+            candidate = self._get_session_candidate(payload["session_id"], filename)
+            source_path = media_cache.get(candidate["url"], candidate["ext"])[0] if candidate else os.path.join(temp_dir, filename)
+            if not source_path or not os.path.exists(source_path):
                 continue
 
             primary_media_type = media_types[0]
@@ -493,7 +705,8 @@ class CustomHandler(SimpleHTTPRequestHandler):
             new_filename = f"{Path(payload['original_rom_path']).stem}-{suffix}{Path(filename).suffix}"
             destination_path = os.path.join(final_media_dir, new_filename)
             
-            shutil.move(os.path.join(temp_dir, filename), destination_path)
+            if candidate: scraper_module.place_media(scraper_module.media_store.add_file(source_path, candidate["url"]), destination_path)
+            else: shutil.move(source_path, destination_path)
             
             relative_path = f"./{os.path.relpath(destination_path, os.path.dirname(gamelist_path)).replace(os.sep, '/')}"
 
@@ -512,30 +725,23 @@ class CustomHandler(SimpleHTTPRequestHandler):
         with open(LOG_PATH, "a", encoding="utf-8") as logf:
             logf.write("--- Updating gamelist with deep scrape results ---\n")
 
-        creds = read_ss_credentials()
-        settings = read_ui_settings()
-        creds["lang"] = settings.get("language")
+        creds = app_settings.credentials()
+        creds["lang"] = app_settings.snapshot()["language"]
 
-        # Get metadata from ScreenScraper
-        data = scraper_module.query_screenscraper(creds, romname=payload['new_rom_name'], systeme=payload['new_system'])
-        if not data:
-            logf.write(f"Could not fetch metadata for {payload['new_rom_name']}. Only media paths will be updated.\n")
-            return
-
-        jeu = data["response"]["jeu"]
-        scraped_name = jeu.get("noms")[0].get("text") if jeu.get("noms") else jeu.get("nom")
-        
-        # Prepare the entry for the gamelist
-        entry_data = {
-            "rom_path": payload['original_rom_path'],
-            "name": scraped_name or payload['new_rom_name'],
-            "description": next((s.get("text", "") for s in jeu.get("synopsis", []) if s.get("langue") == creds["lang"]), ""),
-            "developer": jeu.get("developpeur", {}).get("text", ""),
-            "publisher": jeu.get("editeur", {}).get("text", ""),
-            "players": jeu.get("joueurs", {}).get("text", ""),
-            "genre": next((g["noms"][0].get("text", "") for g in jeu.get("genres", []) if g.get("noms")), ""),
-            "releasedate": f"{next((d.get('text', '') for d in jeu.get('dates', [])), '')}0101T000000"
-        }
+        # Reuse the jeuInfos response of the diagnose step when it was made for the same name, system and language.
+        with diagnose_sessions_lock:
+            session = diagnose_sessions.get(payload["session_id"])
+        if session and session["data"] and (session["rom_name"], session["system_name"], session["lang"]) == (payload['new_rom_name'], payload['new_system'], creds["lang"]):
+            data = session["data"]
+        else:
+            data = scraper_module.query_screenscraper(creds, romname=payload['new_rom_name'], systeme=payload['new_system'])
+        if data:
+            # Prepare the entry for the gamelist
+            entry_data = scraper_module.build_metadata_entry(data["response"]["jeu"], payload['original_rom_path'], payload['new_rom_name'], creds["lang"])
+        else:
+            with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                logf.write(f"Could not fetch metadata for {payload['new_rom_name']}. Only media paths will be updated.\n")
+            entry_data = {"rom_path": payload['original_rom_path']}
 
         # Add only the paths for the media files we actually saved
         for media_type, path in saved_media_paths.items():
@@ -547,16 +753,10 @@ class CustomHandler(SimpleHTTPRequestHandler):
 				
     def run_scrape_thread(self, roms_to_scrape_data):
         try:
-            # Load configs once at the beginning of the thread
-            settings = {
-                **read_ui_settings(), 
-                **read_directory_settings(),
-                **read_media_type_settings(),
-                **read_media_selection_settings()
-            }
-            creds = read_ss_credentials()
-            creds["lang"] = settings.get("language")
-            google_ai_creds = read_google_ai_credentials()
+            # Settings are re-checked per ROM (cheap, see SettingsStore), so edits apply from the next ROM on.
+            settings = app_settings.snapshot()
+            creds = app_settings.credentials()
+            creds["lang"] = settings["language"]
             alt_mappings = scraper_module.load_alt_romnames(ALT_ROM_CSV)
             
             try:
@@ -566,36 +766,86 @@ class CustomHandler(SimpleHTTPRequestHandler):
                     logf.write(f"[FATAL_ERROR] Could not load systems.json: {e}\n")
                 return
 
-            # Main loop for processing each ROM
-            total_roms = len(roms_to_scrape_data) # <--- NEU: Gesamtzahl ermitteln
-            for current_idx, entry in enumerate(roms_to_scrape_data, 1): 
-                if stop_scrape_event.is_set():
-                    with open(LOG_PATH, "a", encoding="utf-8") as logf:
-                        logf.write("\n=== Scrape interrupted by user ===\n")
-                    break
-                
-                xml_path_str, system = entry.get("rom_path"), entry.get("actual_system")
-                if not xml_path_str or not system: continue
-                
-                rom_abs_path = os.path.join(BASE_DIR, system, xml_path_str.lstrip('./'))
-
-                try:
-                    with open(LOG_PATH, "a", encoding="utf-8", errors="replace") as logf:
-                        logf.write(f"\n--- Progress: [{current_idx}/{total_roms}] ---\n")
-                        for log_message in scraper_module.scrape_rom(rom_abs_path, xml_path_str, system, creds, alt_mappings, settings, google_ai_creds.get("api_key"), ALT_ROM_CSV):
-                            if stop_scrape_event.is_set():
-                                break
-                            logf.write(log_message + "\n")
-                            logf.flush()
-                except Exception as e:
+            scraper_module.media_share = scraper_module.MediaShare(CLONE_DATS_DIR)
+            apply_peer_settings(settings)
+            peer = scraper_module.cache_peer
+            peer_before = dict(peer.stats) if peer else None
+            quota = scraper_module.api_quota
+            if quota.refresh(creds):
+                left = quota.remaining()
+                with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                    logf.write(f"[QUOTA] {left if left is not None else 'Unknown number of'} ScreenScraper requests left today.\n")
+            scraper_module.hedging = scraper_module.hedge_policy(settings, quota)
+            if scraper_module.hedging:
+                with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                    logf.write(f"[HEDGE] Hedged lookups on: next lookup after {scraper_module.hedging.delay:g} s, up to {scraper_module.hedging.budget} extra request(s).\n")
+            processor = scraper_module.media_processor = media_postprocess.create(PROCESSED_MEDIA_PATH, settings)
+            if settings["optimize_images"]:
+                with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                    logf.write(f"[POSTPROCESS] Optimizing images for {processor.spec} on {processor.workers} process(es).\n" if processor
+                               else "[WARN] Image optimization is on, but Pillow is not installed (pip install Pillow); images are kept as downloaded.\n")
+
+            # ROMs go through the hash, lookup, download and gamelist stages of scrape_batch, most incomplete
+            # ROMs first. Alternative-name and AI lookups wait until the SHA1/name lookups of the batch are done.
+            entries = prioritize_batch([e for e in roms_to_scrape_data if e.get("rom_path") and e.get("actual_system")], settings)
+            jobs = [(e["actual_system"], os.path.join(BASE_DIR, e["actual_system"], e["rom_path"].lstrip('./')), e["rom_path"]) for e in entries]
+            outcomes = dict.fromkeys(ledger.STATUSES, 0)
+            with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                logf.write(f"[PIPELINE] Threads per stage: {', '.join(f'{k} {v}' for k, v in scraper_module.pipeline_workers(settings).items())}.\n")
+
+            def on_api_error(e):
+                # Pauses the batch; the lookup is retried afterwards unless the user stopped the scrape meanwhile.
+                if isinstance(e, scraper_module.QuotaExhausted): wait_for_quota_reset(quota, creds, str(e))
+                else: wait_for_api(e)
+                return not stop_scrape_event.is_set()
+
+            scrape_state.update({"state": "running", "current": 0, "total": len(jobs)})
+            # app_settings.snapshot is read as each ROM enters the pipeline, so settings edits apply to the ROMs after it.
+            batch = scraper_module.scrape_batch(jobs, creds, alt_mappings, app_settings.snapshot, None, ALT_ROM_CSV, stop_event=stop_scrape_event, on_api_error=on_api_error)
+            for current_idx, ((system, _, xml_path_str), result, lines) in enumerate(batch, 1):
+                scrape_state["current"] = current_idx
+                status = result.get("status")
+                with open(LOG_PATH, "a", encoding="utf-8", errors="replace") as logf:
+                    if lines or status != "interrupted":
+                        logf.write(f"\n--- Progress: [{current_idx}/{len(jobs)}] ---\n" + "".join(f"{line}\n" for line in lines))
+                    if status == "error":
+                        logf.write(f"[FATAL_ERROR] Scraping {Path(xml_path_str).name} failed with an unhandled exception: {result.get('error')}\n")
+                if status == "error":
+                    scrape_ledger.record(system, xml_path_str, "error", message=result.get("error"))
+                    outcomes["error"] += 1
+                elif status in outcomes:
+                    scrape_ledger.record(system, xml_path_str, status, result.get("method"), result.get("game_id"), result.get("media", ()))
+                    outcomes[status] += 1
+
+            if processor:
+                if processor.pending() and not stop_scrape_event.is_set():
                     with open(LOG_PATH, "a", encoding="utf-8") as logf:
-                        logf.write(f"[FATAL_ERROR] Scraping {Path(xml_path_str).name} failed with an unhandled exception: {e}\n")
+                        logf.write(f"\n[POSTPROCESS] Waiting for {processor.pending()} image(s) to be optimized...\n")
+                processor.finish(cancel=stop_scrape_event.is_set())
 
             # Final log message after the loop
-            if not stop_scrape_event.is_set():
-                with open(LOG_PATH, "a", encoding="utf-8") as logf:
-                   logf.write("Scraping complete.\n")
+            with open(LOG_PATH, "a", encoding="utf-8") as logf:
+                logf.write(f"\n[LEDGER] {', '.join(f'{status}: {count}' for status, count in outcomes.items())}\n")
+                if scraper_module.lookup_latency.snapshot():
+                    logf.write(f"[LATENCY] Lookup time per ROM since server start, {scraper_module.lookup_latency.summary()}.\n")
+                if scraper_module.hedging:
+                    logf.write(f"[HEDGE] {scraper_module.hedging.fired} extra request(s) sent.\n")
+                if processor:
+                    logf.write(f"[POSTPROCESS] {processor.summary()}.\n")
+                if peer:
+                    got = {k: v - peer_before[k] for k, v in peer.stats.items()}
+                    logf.write(f"[PEER] {got['responses']} lookup(s) and {got['media']} media file(s) ({got['bytes'] / 2**20:.1f} MB) came from {peer.base_url}"
+                               + (f", {got['rejected']} rejected (hash mismatch)" if got['rejected'] else "") + ".\n")
+                logf.write("\n=== Scrape interrupted by user ===\n" if stop_scrape_event.is_set() else "Scraping complete.\n")
         finally:
+            scrape_state.update({"state": "idle", "resume_at": None})
+            scraper_module.hedging = None
+            if scraper_module.media_processor:
+                scraper_module.media_processor.finish(cancel=True)
+                scraper_module.media_processor = None
+            scraper_module.media_digests.save()
+            scraper_module.media_store.save()
+            scraper_module.api_quota.save()
             # Always release the lock when the thread finishes
             scrape_lock.release()
 
@@ -642,17 +892,30 @@ def run_server():
     if os.path.exists(LOG_PATH):
         try: os.remove(LOG_PATH); print("? Previous log file deleted.")
         except OSError as e: print(f"??  Could not delete log file: {e}")
-    if os.path.isdir(TEMP_MEDIA_DIR):
-        print("?? Cleaning up old temporary media sessions...")
-        for item_name in os.listdir(TEMP_MEDIA_DIR):
-            item_path = os.path.join(TEMP_MEDIA_DIR, item_name)
-            if os.path.isdir(item_path):
-                try: shutil.rmtree(item_path); print(f"  - Removed old session: {item_name}")
-                except Exception as e: print(f"  ?? Could not remove {item_path}: {e}")
     os.makedirs(TEMP_MEDIA_DIR, exist_ok=True)
+    print("?? Cleaning up old temporary media sessions in the background...")
+    threading.Thread(target=cleanup_temp_sessions, daemon=True).start()
+
+    global all_systems_data, scrape_ledger
+    scrape_ledger = ledger.ScrapeLedger(LEDGER_PATH)
+    started = time.perf_counter()
+    snapshot = catalog.load_snapshot(CATALOG_SNAPSHOT_PATH)
+    if snapshot is not None:
+        all_systems_data = snapshot
+        print(f"? Catalog snapshot loaded ({len(snapshot)} games in {(time.perf_counter() - started) * 1000:.0f} ms)")
+    threading.Thread(target=catalog_snapshot_loop, daemon=True).start()
+    threading.Thread(target=discover_roms, daemon=True).start()
+
+    # SIGTERM from the init system ends serve_forever() like Ctrl+C, so the snapshot below gets written.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     httpd = ThreadingHTTPServer(('0.0.0.0', 2020), CustomHandler)
     print(f"? Server running at http://<IP>:2020")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_catalog_snapshot()
 
 if __name__ == "__main__":
     run_server()
\ No newline at end of file
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Typed settings.cfg / ss_dev.cfg access, parsed once and re-read only when a file changes on disk.
+import os, base64, threading, configparser
+from types import MappingProxyType
+
+# {section: {key: default}}; a key's type is its default's type (bool or str).
+SCHEMA = {
+    "user_credentials": {"ssid": "", "sspassword": ""},
+    "google_ai": {"api_key": ""},
+    "general": {"language": "none"},
+    "scraper_flags": {"force": False, "force_metadata": False, "removestockpics": False},
+    "directories": {"save_media_in_rom_dir": False, "name_media_dir": "downloaded_images"},
+    "media_types": {"scrape_image": True, "scrape_video": True, "scrape_marquee": True, "scrape_thumbnail": True,
+                    "source_for_image": "ss", "source_for_box": "box-2D"},
+    "media_selection": {
+        "strategy_for_image": "best_resolution", "strategy_for_video": "best_resolution", "strategy_for_marquee": "best_resolution", "strategy_for_thumbnail": "best_resolution",
+        "preferred_regions": "wor,us,eu,ss,jp", "prefer_light_variants": True,
+        "max_size_mb_for_image": "2", "max_size_mb_for_video": "25", "max_size_mb_for_marquee": "1", "max_size_mb_for_thumbnail": "2",
+        "max_resolution_for_image": "1920x1080", "max_resolution_for_video": "1280x720", "max_resolution_for_marquee": "1280x720", "max_resolution_for_thumbnail": "1920x1080"},
+    "peer": {"share_peer_cache": False, "peer_url": ""},
+    "lookups": {"hedged_lookups": False, "hedge_delay_ms": "1500", "hedge_quota_percent": "5"},
+    "image_processing": {"optimize_images": False, "display_resolution": "1280x720", "image_quality": "85"},
+    "pipeline": {"hash_workers": "2", "lookup_workers": "1", "download_workers": "4"},
+}
+DEV_SCHEMA = {"credentials": {"devid": "", "devpassword": ""}}
+KEY_SECTIONS = {key: section for section, fields in SCHEMA.items() for key in fields}
+
+def decode_if_base64(s):
+    try:
+        if isinstance(s, str) and (any(c in s for c in ['=','/','+']) or len(s)%4==0):
+            d=base64.b64decode(s.encode()).decode("utf-8")
+            if d.isalnum() or "@" in d or d.lower() in ['true','false'] or d.startswith("sk-or-"): return d
+        return s
+    except Exception: return s
+
+def _parse(path, schema):
+    config = configparser.ConfigParser()
+    config.read(path, encoding="utf-8")
+    values = {}
+    for section, fields in schema.items():
+        for key, default in fields.items():
+            value = decode_if_base64(config.get(section, key, fallback=default))
+            values[key] = str(value).strip().lower() == "true" if isinstance(default, bool) else value
+    return values
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+    except (OSError, TypeError):
+        return None
+
+class SettingsStore:
+    """
+    Flat, typed view of settings.cfg (SCHEMA, missing keys at their defaults, booleans as bool).
+    snapshot() costs two os.stat calls while neither file changed and returns a read-only mapping
+    that is replaced, never modified, on reload, so a scrape can keep using the one it holds.
+    """
+    def __init__(self, path, dev_path=None):
+        self.path, self.dev_path = path, dev_path
+        self._lock, self._stamps, self._values, self._dev = threading.Lock(), None, MappingProxyType({}), {}
+
+    def snapshot(self):
+        stamps = (_stamp(self.path), _stamp(self.dev_path))
+        if stamps != self._stamps:
+            with self._lock:
+                if stamps != self._stamps:
+                    self._values = MappingProxyType(_parse(self.path, SCHEMA))
+                    self._dev = _parse(self.dev_path, DEV_SCHEMA) if self.dev_path else {}
+                    self._stamps = stamps
+        return self._values
+
+    def credentials(self):
+        """A new {devid, devpassword, ssid, sspassword} dict, free for the caller to add "lang" to."""
+        values = self.snapshot()
+        return {**self._dev, "ssid": values["ssid"], "sspassword": values["sspassword"]}
+
+    def update(self, values):
+        """Writes the SCHEMA keys among values to their sections with one atomic replace; other keys are ignored."""
+        with self._lock:
+            config = configparser.ConfigParser()
+            config.read(self.path, encoding="utf-8")
+            for key, value in values.items():
+                section = KEY_SECTIONS.get(key)
+                if section is None: continue
+                if not config.has_section(section): config.add_section(section)
+                config.set(section, key, str(value))
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f: config.write(f)
+            os.replace(tmp_path, self.path)
+            self._stamps = None
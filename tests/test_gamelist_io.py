@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import io, os, sys, tempfile, unittest, xml.etree.ElementTree as ET
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gamelist_io
+
+GAMELIST = """<?xml version="1.0"?>
+<gameList version="2">
+\t<provider><System>snes</System></provider>
+\t<game id="1"><path>./A &amp; B.sfc</path><name>Über &lt;A&gt;</name><desc>line one
+line two</desc></game>
+\t<game path="./C.sfc"><name>C</name><image>./downloaded_images/C-image.png</image></game>
+\t<folder><path>./sub</path></folder>
+</gameList>
+"""
+
+class RewriteTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "gamelist.xml")
+        with open(self.path, "w", encoding="utf-8") as f: f.write(GAMELIST)
+
+    def read(self):
+        with open(self.path, "rb") as f: return f.read()
+
+    def expected(self, change=None):
+        """What ElementTree.write produces for the whole tree after change(root)."""
+        tree = ET.ElementTree(ET.fromstring(GAMELIST.split("\n", 1)[1]))
+        if change: change(tree.getroot())
+        out = io.BytesIO()
+        tree.write(out, encoding="utf-8", xml_declaration=True)
+        return out.getvalue()
+
+    def test_unchanged_round_trip_matches_elementtree(self):
+        gamelist_io.rewrite(self.path, lambda el: None)
+        self.assertEqual(self.read(), self.expected())
+
+    def test_edit_drop_and_append(self):
+        def edit(el):
+            if el.tag == "game" and el.get("path") == "./C.sfc":
+                el.find("name").text = "C (edited)"
+            return el.tag != "folder"
+        def append():
+            game = ET.Element("game", path="./D.sfc")
+            ET.SubElement(game, "name").text = "D"
+            return [game]
+        gamelist_io.rewrite(self.path, edit, append)
+        def change(root):
+            root.find("game[@path='./C.sfc']/name").text = "C (edited)"
+            root.remove(root.find("folder"))
+            ET.SubElement(ET.SubElement(root, "game", path="./D.sfc"), "name").text = "D"
+        self.assertEqual(ET.tostring(ET.fromstring(self.read())), ET.tostring(ET.fromstring(self.expected(change))))
+        self.assertEqual([g.get("path") for g, _ in gamelist_io.iter_games(self.path, ())], [None, "./C.sfc", "./D.sfc"])
+
+    def test_missing_and_childless_files(self):
+        os.remove(self.path)
+        gamelist_io.rewrite(self.path, lambda el: None, lambda: [ET.Element("game", path="./A.sfc")])
+        self.assertEqual(gamelist_io.find_game(self.path, "./A.sfc", ("name",)), {})
+        with open(self.path, "w", encoding="utf-8") as f: f.write('<gameList version="2" />')
+        gamelist_io.rewrite(self.path, lambda el: None)
+        self.assertEqual(self.read(), b"<?xml version='1.0' encoding='utf-8'?>\n<gameList version=\"2\"></gameList>")
+
+    def test_parse_error_leaves_the_file_untouched(self):
+        with open(self.path, "a", encoding="utf-8") as f: f.write("<game>")
+        before = self.read()
+        with self.assertRaises(ET.ParseError):
+            gamelist_io.rewrite(self.path, lambda el: None)
+        self.assertEqual(self.read(), before)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["gamelist.xml"])
+
+if __name__ == "__main__":
+    unittest.main()
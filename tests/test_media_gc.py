@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import hashlib, json, os, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import media_gc
+
+def write(path, data=b"x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f: f.write(data)
+    return path
+
+def gamelist(system_dir, *games):
+    write(os.path.join(system_dir, "gamelist.xml"), ("<gameList>%s</gameList>" % "".join(
+        f"<game><path>{rom}</path><image>{image}</image></game>" for rom, image in games)).encode("utf-8"))
+
+class CollectGarbageTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base, self.outside = os.path.join(tmp.name, "roms"), os.path.join(tmp.name, "elsewhere")
+        snes, nes = os.path.join(self.base, "snes"), os.path.join(self.base, "nes")
+        self.kept = [write(os.path.join(snes, "downloaded_images", "A-image.png")),
+                     write(os.path.join(nes, "downloaded_images", "B-image.png")),  # only snes points here
+                     write(os.path.join(self.outside, "C-image.png"))]
+        self.orphan = write(os.path.join(snes, "downloaded_images", "Z-image.png"))
+        self.foreign = write(os.path.join(self.outside, "D-image.png"))  # outside the ROM tree: never touched
+        for rom in ("A", "B", "C"): write(os.path.join(snes, f"{rom}.sfc"))
+        gamelist(snes, ("./A.sfc", "./downloaded_images/A-image.png"), ("./B.sfc", "../nes/downloaded_images/B-image.png"),
+                 ("./C.sfc", self.kept[2]), ("./Gone.sfc", "./downloaded_images/A-image.png"))
+        gamelist(nes)
+
+    def test_dry_run_reports_without_deleting(self):
+        report = media_gc.collect_garbage(self.base, dry_run=True)
+        self.assertEqual([f["path"] for f in report["orphan_files"]], [self.orphan])
+        self.assertEqual([e["rom_path"] for e in report["stale_entries"]], ["./Gone.sfc"])
+        self.assertFalse(report["orphans_deleted"])
+        self.assertTrue(os.path.exists(self.orphan))
+
+    def test_delete_keeps_shared_and_outside_media(self):
+        report = media_gc.collect_garbage(self.base, dry_run=False, prune_entries=True)
+        self.assertTrue(report["orphans_deleted"])
+        self.assertFalse(os.path.exists(self.orphan))
+        for path in self.kept + [self.foreign]: self.assertTrue(os.path.exists(path), path)
+        self.assertEqual(media_gc.collect_garbage(self.base)["stale_count"], 0)
+
+    def test_unparsable_gamelist_keeps_every_orphan(self):
+        write(os.path.join(self.base, "gba", "gamelist.xml"), b"<gameList><game>")
+        gba_orphan = write(os.path.join(self.base, "gba", "downloaded_images", "E-image.png"))
+        report = media_gc.collect_garbage(self.base, dry_run=False)
+        self.assertIn("error", report["systems"]["gba"])
+        self.assertFalse(report["orphans_deleted"])
+        self.assertEqual(report["orphan_count"], 1)
+        self.assertTrue(os.path.exists(self.orphan) and os.path.exists(gba_orphan))
+
+    def test_store_blob_of_an_optimized_image_is_kept(self):
+        store, original = os.path.join(self.base, "..", "store"), b"original image"
+        sha1 = hashlib.sha1(original).hexdigest()
+        blob = write(os.path.join(store, sha1[:2], f"{sha1}.png"), original)
+        unused = write(os.path.join(store, "00", "00unused.png"))
+        image = self.kept[0]
+        os.remove(image); os.link(blob, image)
+        write(f"{image}.pp", b"small")
+        os.replace(f"{image}.pp", image)  # as media_postprocess does: the blob is left with one link
+        record = write(os.path.join(self.base, "..", "processed_media.json"), json.dumps(
+            {image: {"size": 5, "mtime_ns": 0, "spec": "640x480/q85", "source": {"sha1": sha1}, "result": "resized"}}).encode("utf-8"))
+        report = media_gc.collect_garbage(self.base, dry_run=False, store_dir=store, include_store=True, processed_record_path=record)
+        self.assertEqual(report["store_count"], 1)
+        self.assertTrue(os.path.exists(blob))
+        self.assertFalse(os.path.exists(unused))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import hashlib, os, sys, tempfile, unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scraper_module
+
+URL = "https://media.example/box.png?devid=x&crc=1"
+GOOD, BAD = b"good media", b"corrupt media"
+
+class MediaStoreFetchTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base, self.downloads, self.content = tmp.name, [], GOOD
+        self.store = scraper_module.MediaStore(os.path.join(self.base, "store"))
+        def download(url, dest):
+            self.downloads.append(url)
+            with open(dest, "wb") as f: f.write(self.content)
+            return dest, f"[SUCCESS] Saved: {os.path.basename(dest)}"
+        for patch in (mock.patch.object(scraper_module, "download_media", download),
+                      mock.patch.object(scraper_module, "media_digests", scraper_module.MediaDigestCache()),
+                      mock.patch.object(scraper_module, "media_processor", None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.item = {"url": URL, "sha1": hashlib.sha1(GOOD).hexdigest()}
+
+    def dest(self, rom):
+        return os.path.join(self.base, "media", f"{rom}-image.png")
+
+    def read(self, path):
+        with open(path, "rb") as f: return f.read()
+
+    def test_second_rom_reuses_the_stored_file(self):
+        self.store.fetch(URL, self.dest("A"), self.item)
+        path, msg = self.store.fetch(URL, self.dest("B"), self.item)
+        self.assertTrue(msg.startswith("[STORE] Reused"), msg)
+        self.assertEqual(len(self.downloads), 1)
+        self.assertEqual(self.read(path), GOOD)
+
+    def test_corrupt_stored_file_is_downloaded_again(self):
+        self.store.fetch(URL, self.dest("A"), self.item)
+        blob = self.store.blob_for(URL)
+        os.remove(blob)  # a broken copy under the good name; dest A keeps its own link
+        with open(blob, "wb") as f: f.write(BAD)
+        path, msg = self.store.fetch(URL, self.dest("B"), self.item)
+        self.assertIn("failed the checksum", msg)
+        self.assertEqual(len(self.downloads), 2)
+        self.assertEqual(self.read(path), GOOD)
+        self.assertEqual(self.read(self.store.blob_for(URL)), GOOD)
+
+    def test_outdated_stored_file_is_replaced_in_the_index(self):
+        self.store.fetch(URL, self.dest("A"), self.item)
+        old_blob = self.store.blob_for(URL)
+        self.content = b"newer media"
+        path, msg = self.store.fetch(URL, self.dest("B"), {"url": URL, "sha1": hashlib.sha1(self.content).hexdigest()})
+        self.assertFalse(msg.startswith("[STORE]"), msg)
+        self.assertEqual(len(self.downloads), 2)
+        self.assertEqual(self.read(path), self.content)
+        self.assertEqual(self.read(self.dest("A")), GOOD)
+        self.assertFalse(os.path.exists(old_blob))  # no other URL used it
+
+    def test_copy_only_filesystem_keeps_one_copy(self):
+        with mock.patch.object(scraper_module.os, "link", side_effect=OSError), \
+             mock.patch.object(scraper_module.os, "symlink", side_effect=OSError):
+            path, _ = self.store.fetch(URL, self.dest("A"), self.item)
+            self.assertEqual(self.store.blob_for(URL), os.path.abspath(path))
+            blobs = [f for _, _, files in os.walk(self.store.store_dir) for f in files]
+            self.assertEqual(blobs, [])
+            path, msg = self.store.fetch(URL, self.dest("B"), self.item)
+        self.assertIn("Reused stored file (copy)", msg)
+        self.assertEqual(len(self.downloads), 1)
+        self.assertEqual(self.read(path), GOOD)
+
+if __name__ == "__main__":
+    unittest.main()
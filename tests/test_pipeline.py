@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os, sys, tempfile, threading, unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scraper_module
+
+class ScrapeBatchDeferredTest(unittest.TestCase):
+    def run_batch(self, query, alt_mappings, count=6):
+        with tempfile.TemporaryDirectory() as base:
+            os.makedirs(os.path.join(base, "snes"))
+            jobs = []
+            for i in range(1, count + 1):
+                rom_file = os.path.join(base, "snes", f"R{i}.sfc")
+                with open(rom_file, "wb") as f: f.write(os.urandom(64))
+                jobs.append(("snes", rom_file, f"./R{i}.sfc"))
+            out = []
+            def consume():
+                out.extend(scraper_module.scrape_batch(jobs, {}, alt_mappings, {"lookup_workers": "1"}))
+            with mock.patch.object(scraper_module, "BASE_ROM_PATH", base), \
+                 mock.patch.object(scraper_module, "query_screenscraper", query), \
+                 mock.patch.object(scraper_module, "update_gamelist", lambda *a, **k: None), \
+                 mock.patch.object(scraper_module, "media_share", scraper_module.MediaShare()):
+                worker = threading.Thread(target=consume, daemon=True)
+                worker.start()
+                worker.join(30)
+            self.assertFalse(worker.is_alive(), "scrape_batch did not finish")
+            return out
+
+    def test_deferred_lookups_finish_with_one_lookup_worker(self):
+        alts = {f"R{i}": [{"alt_name": f"alt-R{i}", "src_system": None, "dest_system": None}] for i in range(1, 7)}
+        out = self.run_batch(lambda *a, **k: None, alts)
+        self.assertEqual(sorted(result["status"] for _, result, _ in out), ["failed"] * 6)
+
+    def test_alternative_names_run_after_all_direct_lookups(self):
+        calls = []
+        def query(creds, sha1=None, romname=None, systeme=None, **kw):
+            calls.append(romname or sha1)
+            if romname and romname.startswith("alt-"):
+                return {"response": {"jeu": {"id": romname, "noms": [{"text": romname}], "medias": []}}}
+            return None
+        alts = {f"R{i}": [{"alt_name": f"alt-R{i}", "src_system": None, "dest_system": None}] for i in (1, 2, 3)}
+        out = self.run_batch(query, alts)
+        statuses = {job[2]: result["status"] for job, result, _ in out}
+        self.assertEqual(statuses, {"./R1.sfc": "matched", "./R2.sfc": "matched", "./R3.sfc": "matched",
+                                    "./R4.sfc": "failed", "./R5.sfc": "failed", "./R6.sfc": "failed"})
+        first_alt = min(i for i, call in enumerate(calls) if str(call).startswith("alt-"))
+        self.assertTrue(all(not str(call).startswith("alt-") for call in calls[:first_alt]))
+        self.assertEqual(sum(1 for call in calls[:first_alt] if call in {f"R{i}" for i in range(1, 7)}), 6)
+
+if __name__ == "__main__":
+    unittest.main()